@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+A synthetic CADA corpus generator.
+
+Advices are built (not saved) from the test suite `AdviceFactory`
+with realistic vocabularies and content lengths.
+The same `seed` always generates the same corpus.
+"""
+import os
+import random
+import sys
+
+from datetime import datetime
+
+import factory
+import factory.random
+
+from faker import Faker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from conftest import AdviceFactory  # noqa: E402
+
+TOPICS = {
+    'Urbanisme': ['Permis De Construire', 'Certificat D\'Urbanisme', 'Plan Local D\'Urbanisme'],
+    'Fonction Publique': ['Dossier Individuel', 'Recrutement', 'Notation'],
+    'Collectivités Territoriales': ['Délibérations', 'Budget', 'Arrêtés Du Maire'],
+    'Marchés Publics Et Contrats': ['Offres', 'Rapport D\'Analyse', 'Acte D\'Engagement'],
+    'Environnement': ['Eau', 'Déchets', 'Installations Classées'],
+    'Santé': ['Dossier Médical', 'Établissements De Santé'],
+    'Police Et Sécurité': ['Procès-Verbaux', 'Vidéoprotection'],
+    'Fiscalité': ['Impôts Locaux', 'Contrôle Fiscal'],
+    'Enseignement': ['Examens Et Concours', 'Inscriptions'],
+    'Agriculture': ['Aides', 'Contrôles'],
+}
+
+TAGS = [
+    'Permis de construire', 'Marché public', 'Délibération', 'Dossier médical', 'Rapport', 'Contrat',
+    'Budget', 'Correspondance', 'Procès-verbal', 'Arrêté', 'Convention', 'Subvention', 'Facture',
+    'Compte rendu', 'Étude', 'Plan', 'Registre', 'Audit', 'Note', 'Statistiques',
+]
+
+MEANINGS = [
+    'Favorable', 'Défavorable/Secret des affaires', 'Défavorable/Vie privée', 'Sans objet/Inexistant',
+    'Sans objet/Communiqué', 'Irrecevable', 'Incompétence', 'Favorable/Sous réserve d\'occultation',
+]
+
+TYPES = ['Avis', 'Avis', 'Avis', 'Conseil', 'Sanction']
+
+ADMINISTRATIONS = [
+    'Maire de {city}', 'Préfet de {department}', 'Président du conseil départemental de {department}',
+    'Directeur du centre hospitalier de {city}', 'Recteur de l\'académie de {city}',
+    'Directeur général des finances publiques', 'Ministre de l\'intérieur',
+]
+
+REQUESTS = [
+    'communication de la copie {0}',
+    'communication par courrier électronique {0}',
+    'consultation sur place {0}',
+]
+
+DOCUMENTS = [
+    'du permis de construire délivré le {date}',
+    'des délibérations du conseil municipal du {date}',
+    'du rapport d\'analyse des offres du marché',
+    'de son dossier médical',
+    'des procès-verbaux de la séance du {date}',
+    'du budget primitif et du compte administratif',
+]
+
+PREFIXES = ['Madame', 'Monsieur', 'M.', 'Mme', 'Maître']
+
+# Share of the advices naming a person, as candidates to anonymization
+NAMED_RATIO = 0.1
+
+SESSIONS_RANGE = (datetime(2005, 1, 1), datetime(2019, 12, 31))
+
+# Median and spread of the content length, in characters
+CONTENT_LENGTH_MU = 7
+CONTENT_LENGTH_SIGMA = 0.6
+
+fake = Faker('fr_FR')
+rnd = random.Random()
+
+
+def administration():
+    return rnd.choice(ADMINISTRATIONS).format(city=fake.city(), department=fake.city())
+
+
+def session():
+    return datetime.combine(fake.date_between_dates(*SESSIONS_RANGE), datetime.min.time())
+
+
+def subject():
+    date = fake.date_between_dates(*SESSIONS_RANGE).strftime('%d/%m/%Y')
+    text = rnd.choice(REQUESTS).format(rnd.choice(DOCUMENTS).format(date=date))
+    return text[0].upper() + text[1:] + '.'
+
+
+def topics():
+    topics = []
+    for topic in rnd.sample(sorted(TOPICS), rnd.randint(1, 2)):
+        topics.append('{0}/{1}'.format(topic, rnd.choice(TOPICS[topic])))
+    return topics
+
+
+def content():
+    '''Paragraphs of a log-normal total length, sometimes naming a person'''
+    length = int(rnd.lognormvariate(CONTENT_LENGTH_MU, CONTENT_LENGTH_SIGMA))
+    sentences = []
+    if rnd.random() < NAMED_RATIO:
+        sentences.append('{0} {1} a saisi la commission d\'accès aux documents administratifs.'.format(
+            rnd.choice(PREFIXES), fake.last_name()
+        ))
+    while sum(len(s) + 1 for s in sentences) < length:
+        sentences.append(fake.sentence(nb_words=rnd.randint(8, 25)))
+    return ' '.join(sentences)
+
+
+class CorpusAdviceFactory(AdviceFactory):
+    # Real advices ids are the year followed by a number
+    id = factory.Sequence(lambda n: '{0}{1:04d}'.format(2010 + n // 10000, n % 10000))
+    administration = factory.LazyFunction(administration)
+    type = factory.LazyFunction(lambda: rnd.choice(TYPES))
+    session = factory.LazyFunction(session)
+    subject = factory.LazyFunction(subject)
+    topics = factory.LazyFunction(topics)
+    tags = factory.LazyFunction(lambda: rnd.sample(TAGS, rnd.randint(0, 4)))
+    meanings = factory.LazyFunction(lambda: [rnd.choice(MEANINGS)])
+    content = factory.LazyFunction(content)
+
+
+def generate(size, seed=42):
+    '''Build `size` unsaved advices, always the same ones for a given `seed`'''
+    rnd.seed(seed)
+    fake.seed_instance(seed)
+    factory.random.reseed_random(seed)
+    CorpusAdviceFactory.reset_sequence(force=True)
+    return CorpusAdviceFactory.build_batch(size)
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Time the main CADA operations on a synthetic corpus and write a JSON report.
+
+Requires a MongoDB and an Elasticsearch server (see `docker-compose.yml`):
+    $ python benchmarks/run.py --size 5000 --output report.json
+    $ python benchmarks/run.py --size 5000 --compare report.json
+"""
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+
+from datetime import datetime
+from time import perf_counter
+
+import click
+import pkg_resources
+
+from werkzeug.datastructures import MultiDict
+
+import corpus
+
+from cada import create_app, csv
+from cada.cache import cache
+from cada.commands import cli, echo, header, success, warning, white, green, red
+from cada.models import db, Advice
+from cada.search import FACETS, LIST_FIELDS, es, bulk_index, index, search_advices
+
+# Rows per bulk write, as `cada load` does by default
+BATCH_SIZE = 1000
+
+# Relative median variations below this threshold are reported as stable
+STABLE_THRESHOLD = 0.05
+
+BENCHMARKS = []
+
+
+def benchmark(name, setup=None, items='advices'):
+    '''
+    Register a benchmark, run in registration order after its `setup`.
+
+    Timings are also given per `items` of the context (advices or queries).
+    '''
+    def wrapper(func):
+        BENCHMARKS.append((name, func, setup, items))
+        return func
+    return wrapper
+
+
+class BenchConfig:
+    # TESTING uses the test index instead of the application one
+    TESTING = True
+    MONGODB_DB = 'cada-bench'
+    WTF_CSRF_ENABLED = False
+    SERVER_NAME = 'localhost'
+
+
+def reset_db(ctx):
+    Advice.drop_collection()
+
+
+def reset_index(ctx):
+    es.indices.delete(index='{0}-*'.format(es.index_name), ignore=[400, 404])
+    es.initialize()
+
+
+def load_corpus(ctx):
+    '''Ensure the corpus is stored and indexed, as the read benchmarks expect it'''
+    if Advice.objects.count() != len(ctx['advices']):
+        reset_db(ctx)
+        csv.from_rows(ctx['rows'])
+    if es.count(index=es.index_name)['count'] != len(ctx['advices']):
+        reset_index(ctx)
+        bulk_index(ctx['advices'])
+    es.indices.refresh(index=es.index_name)
+    cache.invalidate()
+
+
+@benchmark('csv.from_row', setup=reset_db)
+def bench_from_row(ctx):
+    for row in ctx['rows']:
+        csv.from_row(row)
+
+
+@benchmark('csv.from_rows', setup=reset_db)
+def bench_from_rows(ctx):
+    rows = ctx['rows']
+    for start in range(0, len(rows), BATCH_SIZE):
+        csv.from_rows(rows[start:start + BATCH_SIZE])
+
+
+@benchmark('search.index', setup=reset_index)
+def bench_index(ctx):
+    for advice in ctx['advices']:
+        index(advice)
+
+
+@benchmark('search.bulk_index', setup=reset_index)
+def bench_bulk_index(ctx):
+    bulk_index(ctx['advices'])
+
+
+def cold_cache(ctx):
+    load_corpus(ctx)
+    cache.clear()
+
+
+@benchmark('search_advices', setup=cold_cache, items='queries')
+def bench_search(ctx):
+    for args in ctx['queries']:
+        cache.clear()
+        search_advices(LIST_FIELDS, args=args, facets=FACETS)
+
+
+def search_queries(ctx):
+    for args in ctx['queries']:
+        search_advices(LIST_FIELDS, args=args, facets=FACETS)
+
+
+def warm_cache(ctx):
+    load_corpus(ctx)
+    search_queries(ctx)
+
+
+@benchmark('search_advices (cached)', setup=warm_cache, items='queries')
+def bench_search_cached(ctx):
+    search_queries(ctx)
+
+
+@benchmark('export_csv', setup=load_corpus)
+def bench_export(ctx):
+    for chunk in csv.export():
+        pass
+
+
+@benchmark('csv.write_export', setup=load_corpus)
+def bench_write_export(ctx):
+    csv.write_export(os.path.join(ctx['workdir'], 'cada.csv.gz'))
+
+
+@benchmark('sitemap', setup=cold_cache)
+def bench_sitemap(ctx):
+    client = ctx['app'].test_client()
+    page = 1
+    assert client.get('/sitemap.xml').status_code == 200
+    while client.get('/sitemap-{0}.xml'.format(page)).status_code == 200:
+        page += 1
+
+
+@benchmark('anon', setup=load_corpus)
+def bench_anon(ctx):
+    args = ['anon', '--full', '--processes', str(ctx['processes'])]
+    result = ctx['app'].test_cli_runner().invoke(cli, args)
+    assert result.exit_code == 0, result.output
+
+
+def build_queries(advices):
+    '''Search arguments mixing full text, facets filters and sorts'''
+    queries = [MultiDict()]
+    for word in ('permis', 'délibérations', 'dossier médical', 'marché', 'budget'):
+        queries.append(MultiDict({'q': word}))
+    queries.append(MultiDict({'sort': 'session desc'}))
+    queries.append(MultiDict({'q': 'copie', 'sort': 'administration asc', 'page': 3}))
+    for advice in advices[:3]:
+        queries.append(MultiDict({'tag': advice.tags[:1], 'topic': advice.topics[:1]}))
+    return queries
+
+
+def measure(func, setup, items, ctx, repeat):
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup(ctx)
+        start = perf_counter()
+        func(ctx)
+        timings.append(perf_counter() - start)
+    median = statistics.median(timings)
+    items = len(ctx[items])
+    return {
+        'repeat': repeat,
+        'items': items,
+        'min': min(timings),
+        'median': median,
+        'mean': statistics.mean(timings),
+        'max': max(timings),
+        'per_item_ms': median * 1000 / items if items else None,
+    }
+
+
+def compare(result, previous):
+    '''Describe the median variation against a previous result'''
+    if not previous or previous.get('items') != result['items']:
+        return ''
+    ratio = result['median'] / previous['median'] if previous['median'] else 1
+    if abs(ratio - 1) < STABLE_THRESHOLD:
+        return 'stable'
+    elif ratio < 1:
+        return green('{0:.2f}x faster'.format(1 / ratio))
+    return red('{0:.2f}x slower'.format(ratio))
+
+
+def metadata(size, repeat, seed):
+    return {
+        'date': datetime.utcnow().isoformat(),
+        'version': pkg_resources.get_distribution('cada').version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'size': size,
+        'repeat': repeat,
+        'seed': seed,
+        'mongodb': db.connection.server_info()['version'],
+        'elasticsearch': es.info()['version']['number'],
+    }
+
+
+@click.command()
+@click.option('-s', '--size', default=1000, help='Number of advices in the corpus')
+@click.option('-r', '--repeat', default=3, help='Number of runs of each benchmark')
+@click.option('--seed', default=42, help='Corpus generation seed')
+@click.option('-p', '--processes', default=1, help='Number of processes of the anon scan')
+@click.option('-b', '--only', multiple=True, help='Only run these benchmarks')
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Write the JSON report into this file')
+@click.option('-c', '--compare', 'previous', type=click.File('r'), help='Compare with a previous JSON report')
+@click.option('--mongodb-host', help='MongoDB URI (default to the application one)')
+@click.option('--elasticsearch-url', help='Elasticsearch URL (default to the application one)')
+def main(size, repeat, seed, processes, only, output, previous, mongodb_host, elasticsearch_url):
+    '''Benchmark CADA on a synthetic corpus'''
+    overrides = {}
+    if mongodb_host:
+        overrides['MONGODB_HOST'] = mongodb_host
+    if elasticsearch_url:
+        overrides['ELASTICSEARCH_URL'] = elasticsearch_url
+    app = create_app(type('Config', (BenchConfig,), overrides))
+    previous = json.load(previous)['results'] if previous else {}
+
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)  # anon also writes its output in the working directory
+    try:
+        with app.test_request_context('/'):
+            app.config['EXPORT_PATH'] = os.path.join(workdir, 'cada.csv.gz')
+            header('Generating a corpus of {0} advices', size)
+            advices = corpus.generate(size, seed)
+            ctx = {
+                'app': app,
+                'workdir': workdir,
+                'processes': processes,
+                'advices': advices,
+                'rows': [csv.to_row(advice) for advice in advices],
+                'queries': build_queries(advices),
+            }
+            report = {'meta': metadata(size, repeat, seed), 'results': {}}
+
+            for name, func, setup, items in BENCHMARKS:
+                if only and name not in only:
+                    continue
+                result = measure(func, setup, items, ctx, repeat)
+                report['results'][name] = result
+                echo('{0}: {1:.3f}s ({2:.3f}ms per item) {3}',
+                     white(name), result['median'], result['per_item_ms'],
+                     compare(result, previous.get(name)))
+
+            db.connection.drop_database(app.config['MONGODB_DB'])
+            es.indices.delete(index='{0}-*'.format(es.index_name), ignore=[400, 404])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        success('Report written into {0}', output)
+    elif not previous:
+        warning('No report written, use --output to keep it')
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,8 @@ def create_app(config=None):
 
     from cada import views, api
     from cada.assets import assets
+    from cada.cache import cache
+    from cada.compress import compress
     from cada.models import db
     from cada.search import es
 
@@ -40,6 +42,8 @@ def create_app(config=None):
 
     db.init_app(app)
     es.init_app(app)
+    cache.init_app(app)
+    compress.init_app(app)
     assets.init_app(app)
     views.init_app(app)
     api.init_app(app)
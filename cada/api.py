@@ -1,22 +1,39 @@
 # -*- coding: utf-8 -*-
-from flask import Blueprint, render_template, jsonify, json, url_for
+from datetime import datetime
 
-from cada.models import Advice
-from cada.search import search_advices
+from flask import (
+    Blueprint, Response, abort, current_app, render_template, jsonify, json, request, stream_with_context
+)
+
+from werkzeug.datastructures import MultiDict
 
-import requests
+from cada.cache import cache, advice_version, not_modified, set_conditional_headers
+from cada.models import Advice
+from cada.search import es, search_advices, search_facets
 
 api = Blueprint('api', __name__)
 
+FIELDS = ('id', 'administration', 'type', 'session', 'subject', 'topics', 'tags', 'meanings', 'part', 'content')
+
+DEFAULT_MAX_BATCH_SIZE = 1000
+
+# Number of documents fetched per MongoDB round trip by the dump
+DUMP_CURSOR_SIZE = 1000
+
+DUMP_FILTERS = {
+    'modified': 'last_modified',
+    'session': 'session',
+}
+
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S')
+
+SAMPLE_SEARCH = {'q': 'Paris', 'sort': 'session desc', 'page_size': 3}
+
 
 @api.route('/')
 def doc():
-    sample = {
-        "advice": Advice.objects.first(),
-        "search": sample_search()
-    }
-
-    return render_template('api.html', sample=sample)
+    sample = cache.get_or_set('api:sample', sample_data)
+    return render_template('api.html', sample=sample, sample_search=SAMPLE_SEARCH)
 
 
 @api.route('/search')
@@ -26,26 +43,137 @@ def search():
     return jsonify(results)
 
 
+@api.route('/facets')
+def facets():
+    return jsonify(search_facets())
+
+
+def _split(values):
+    '''Flatten a value or a list of possibly comma-separated values'''
+    if not isinstance(values, (list, tuple)):
+        values = [values]
+    return [v.strip() for value in values for v in str(value).split(',') if v.strip()]
+
+
+@api.route('/advices', methods=['GET', 'POST'])
+def batch():
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            abort(400, 'Expected a JSON object')
+        ids = _split(data.get('ids') or [])
+        fields = _split(data.get('fields') or [])
+    else:
+        ids = _split(request.args.getlist('ids'))
+        fields = _split(request.args.getlist('fields'))
+
+    ids = list(dict.fromkeys(ids))  # Deduplicate while keeping order
+    if not ids:
+        abort(400, 'No advice id provided')
+    if len(ids) > current_app.config['API_MAX_BATCH_SIZE']:
+        abort(400, 'Too many ids (max. {0})'.format(current_app.config['API_MAX_BATCH_SIZE']))
+    if any(f not in FIELDS for f in fields):
+        abort(400, 'Unknown field (expected one of {0})'.format(', '.join(FIELDS)))
+    fields = fields or FIELDS
+
+    advices = Advice.objects.only(*fields).in_bulk(ids)
+
+    def generate():
+        yield '{"advices":['
+        for idx, advice in enumerate(advices[id] for id in ids if id in advices):
+            yield (',' if idx else '') + json.dumps(_serialize(advice, fields))
+        yield '],"missing":'
+        yield json.dumps([id for id in ids if id not in advices])
+        yield '}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def _parse_date(value):
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    abort(400, 'Invalid date: {0}'.format(value))
+
+
+@api.route('/dump')
+def dump():
+    query = {}
+    if request.args.get('since'):
+        by = request.args.get('by', 'modified')
+        if by not in DUMP_FILTERS:
+            abort(400, 'Unknown filter (expected one of {0})'.format(', '.join(DUMP_FILTERS)))
+        query[DUMP_FILTERS[by]] = {'$gte': _parse_date(request.args['since'])}
+
+    cursor = Advice._get_collection().find(
+        query, FIELDS[1:], sort=[('_id', 1)], batch_size=DUMP_CURSOR_SIZE
+    )
+
+    def generate():
+        for advice in cursor:
+            yield json.dumps(_serialize(advice)) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@api.route('/stats')
+def stats():
+    """Connection pools and cache usage of the serving process, if enabled"""
+    if not current_app.config['API_STATS']:
+        abort(404)
+    return jsonify({
+        'elasticsearch': es.pool_stats(),
+        'cache': cache.stats(),
+    })
+
+
 @api.route('/<id>/')
 def display(id):
+    version = advice_version(id)
+    if version is None:
+        abort(404)
+    etag, last_modified = version
+    cache_control = 'public, max-age={0}'.format(current_app.config['API_CACHE_MAX_AGE'])
+    response = not_modified(etag, last_modified, cache_control)
+    if response:
+        return response
     advice = Advice.objects.get_or_404(id=id)
-    return jsonify(_serialize(advice))
+    return set_conditional_headers(jsonify(_serialize(advice)), etag, last_modified, cache_control)
 
 
 @api.app_template_filter()
-def _serialize(advice):
-    return {
-        'id': advice.id,
-        'administration': advice.administration,
-        'type': advice.type,
-        'session': advice.session,
-        'subject': advice.subject,
-        'topics': advice.topics,
-        'tags': advice.tags,
-        'meanings': advice.meanings,
-        'part': advice.part,
-        'content': advice.content,
-    }
+def _serialize(advice, fields=None):
+    if isinstance(advice, dict):  # Raw MongoDB document
+        data = {
+            'id': advice['_id'],
+            'administration': advice.get('administration'),
+            'type': advice.get('type'),
+            'session': advice.get('session'),
+            'subject': advice.get('subject'),
+            'topics': advice.get('topics', []),
+            'tags': advice.get('tags', []),
+            'meanings': advice.get('meanings', []),
+            'part': advice.get('part'),
+            'content': advice.get('content'),
+        }
+    else:
+        data = {
+            'id': advice.id,
+            'administration': advice.administration,
+            'type': advice.type,
+            'session': advice.session,
+            'subject': advice.subject,
+            'topics': advice.topics,
+            'tags': advice.tags,
+            'meanings': advice.meanings,
+            'part': advice.part,
+            'content': advice.content,
+        }
+    if fields:
+        data = dict((field, data[field]) for field in fields)
+    return data
 
 
 @api.app_template_filter()
@@ -54,10 +182,22 @@ def pretty_json(value):
 
 
 def init_app(app):
+    app.config.setdefault('API_MAX_BATCH_SIZE', DEFAULT_MAX_BATCH_SIZE)
+    app.config.setdefault('API_CACHE_MAX_AGE', 3600)
+    app.config.setdefault('API_STATS', False)
     app.register_blueprint(api, url_prefix='/api')
 
 
-def sample_search():
-    r = requests.get(url_for('api.search', q='Paris', sort='session desc', page_size=3, _external=True))
+def sample_data():
+    """The serialized samples displayed on the documentation, computed in-process"""
+    advice = Advice.objects.first()
+    return {
+        "advice": _serialize(advice) if advice else None,
+        "search": sample_search(),
+    }
+
 
-    return r.json()
+def sample_search():
+    results = search_advices(args=MultiDict(SAMPLE_SEARCH))
+    results['advices'] = [_serialize(a) for a in results['advices']]
+    return results
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+
+from collections import Counter, OrderedDict
+from time import time
+
+from cachelib import BaseCache, FileSystemCache
+from flask import Response, current_app, request
+
+from cada.models import Advice
+
+log = logging.getLogger(__name__)
+
+GENERATION_KEY = "generation"
+
+
+class LRUCache(BaseCache):
+    """
+    An in-process cache evicting the least recently used items
+    once `threshold` is reached.
+
+    Values are stored by reference: they must not be mutated once cached.
+    """
+
+    def __init__(self, threshold=500, default_timeout=300):
+        super(LRUCache, self).__init__(default_timeout)
+        self._items = OrderedDict()
+        self._threshold = threshold
+        self._lock = threading.Lock()
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return time() + timeout if timeout > 0 else 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._items[key]
+            except KeyError:
+                return None
+            if expires and expires <= time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._items[key] = (self._expires(timeout), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self._threshold:
+                self._items.popitem(last=False)
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._items.pop(key, None) is not None
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+        return True
+
+
+class Cache(object):
+    def __init__(self, app=None):
+        self.hits = Counter()
+        self.misses = Counter()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CACHE_TYPE", "simple")
+        app.config.setdefault("CACHE_DIR", os.path.join(app.instance_path, "cache"))
+        app.config.setdefault("CACHE_DEFAULT_TIMEOUT", 3600)
+        app.config.setdefault("CACHE_GENERATION_TIMEOUT", 60)
+        app.config.setdefault("CACHE_THRESHOLD", 500)
+        app.extensions["cache"] = self.create_backend(app.config)
+        self.hits.clear()
+        self.misses.clear()
+
+    def create_backend(self, config):
+        """Instanciate the cache backend matching the `CACHE_TYPE` setting"""
+        kwargs = {
+            "threshold": config["CACHE_THRESHOLD"],
+            "default_timeout": config["CACHE_DEFAULT_TIMEOUT"],
+        }
+        if config["CACHE_TYPE"] == "simple":
+            return LRUCache(**kwargs)
+        elif config["CACHE_TYPE"] == "filesystem":
+            return FileSystemCache(config["CACHE_DIR"], **kwargs)
+        elif config["CACHE_TYPE"] == "redis":
+            # Optional dependency
+            import redis
+            from cachelib import RedisCache
+
+            return RedisCache(
+                host=redis.from_url(config["CACHE_REDIS_URL"]),
+                default_timeout=config["CACHE_DEFAULT_TIMEOUT"],
+                key_prefix=config.get("CACHE_KEY_PREFIX", "cada:"),
+            )
+        raise ValueError("Unknown cache type: {0}".format(config["CACHE_TYPE"]))
+
+    def __getattr__(self, item):
+        if "cache" not in current_app.extensions.keys():
+            raise Exception("not initialised, did you forget to call init_app?")
+        return getattr(current_app.extensions["cache"], item)
+
+    @property
+    def generation(self):
+        """
+        The current index generation, checked at most once per `CACHE_GENERATION_TIMEOUT`.
+
+        Returns `None` if Elasticsearch is unreachable.
+        """
+        from cada.search import es
+
+        generation = self.get(GENERATION_KEY)
+        if generation is None:
+            try:
+                generation = es.generation
+            except Exception:
+                log.exception("Unable to fetch the index generation")
+                return
+            self.set(
+                GENERATION_KEY,
+                generation,
+                timeout=current_app.config["CACHE_GENERATION_TIMEOUT"],
+            )
+        return generation
+
+    def invalidate(self):
+        """Bump the index generation, invalidating every cached value"""
+        from cada.search import es
+
+        es.bump_generation()
+        self.delete(GENERATION_KEY)
+
+    def get_or_set(self, key, func, timeout=None):
+        """
+        Get a cached value or compute it with `func` and cache it.
+
+        Values are bound to the current index generation.
+        """
+        generation = self.generation
+        if generation is None:
+            return func()
+        namespace = key.split(":", 1)[0]
+        key = "{0}:{1}".format(generation, key)
+        value = self.get(key)
+        if value is None:
+            self.misses[namespace] += 1
+            value = func()
+            self.set(key, value, timeout=timeout)
+        else:
+            self.hits[namespace] += 1
+        return value
+
+    def stats(self):
+        """Hits and misses counters of this process, by key namespace"""
+        return {
+            namespace: {"hits": self.hits[namespace], "misses": self.misses[namespace]}
+            for namespace in sorted(set(self.hits) | set(self.misses))
+        }
+
+
+cache = Cache()
+
+
+def advice_version(id):
+    """
+    The `(fingerprint, last_modified)` version of an advice, cached per index generation.
+
+    Returns `None` if the advice does not exist.
+    """
+
+    def fetch():
+        advice = Advice.objects.only("fingerprint", "last_modified").filter(id=id).first()
+        if advice is None:
+            return
+        if not advice.fingerprint:  # Advice stored before fingerprints
+            advice = Advice.objects.get(id=id)
+            advice.fingerprint = advice.compute_fingerprint()
+        return advice.fingerprint, advice.last_modified
+
+    return cache.get_or_set("version:{0}".format(id), fetch)
+
+
+def set_conditional_headers(response, etag, last_modified=None, cache_control="no-cache"):
+    """Set the validators and the caching policy headers on a response"""
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+
+def not_modified(etag, last_modified=None, cache_control="no-cache"):
+    """
+    Build a `304 Not Modified` response if the request validators match,
+    so it can be returned before any rendering.
+
+    Returns `None` if the full response is required.
+    """
+    if request.if_none_match:
+        matches = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified:
+        matches = last_modified.replace(microsecond=0) <= request.if_modified_since
+    else:
+        matches = False
+    if matches:
+        return set_conditional_headers(Response(status=304), etag, last_modified, cache_control)
@@ -1,24 +1,36 @@
 # -*- coding: utf-8 -*-
 import click
 import logging
+import multiprocessing
+import os
 import pkg_resources
 import shutil
 import sys
 import re
 import requests
+import tempfile
 
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from glob import iglob
+from itertools import islice
 from os.path import exists
 
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from webassets.script import CommandLineEnvironment
+from flask import current_app
 from flask.cli import FlaskGroup, shell_command, run_command, routes_command
 
 from tqdm import tqdm
 
 from cada import create_app, csv
 from cada.assets import assets
-from cada.models import Advice
-from cada.search import es, index
+from cada.cache import cache
+from cada.compress import precompress_static
+from cada.models import Advice, Checkpoint, Source
+from cada.search import es, bulk_index, refresh_disabled
 
 log = logging.getLogger(__name__)
 
@@ -30,26 +42,46 @@ HEADER = "✯"
 
 NO_CAST = (int, float, bool)
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 CONTEXT_SETTINGS = {
     "auto_envvar_prefix": "cada",
     "help_option_names": ["-?", "-h", "--help"],
 }
 
 KNOWN_PREFIXES = [
-    r"M\. ",
-    "Mme ",
+    "M.",
+    "Mme",
     "Monsieur",
     "Madame",
-    "Mlle ",
+    "Mlle",
     "Docteur",
-    "Dr ",
-    "Mr ",
+    "Dr",
+    "Mr",
     "Maître",
-    "Me ",
+    "Me",
     "Mademoiselle",
 ]
 
-PREFIXES = "|".join([re.escape(p) for p in KNOWN_PREFIXES])
+# Longest prefixes first so that the alternation never stops on a shorter one
+PREFIXES = "|".join(re.escape(p) for p in sorted(KNOWN_PREFIXES, key=len, reverse=True))
+
+# This regex is to match names after the prefixes, compiled once for all scans.
+MATCHER = re.compile(r"\b(%s)\s+([A-Z][^X\s\.\-\,]\w+)(\s+)?([A-Z]\.)?" % PREFIXES)
+
+ANON_FILENAME = "urls_to_check.csv"
+
+# Only the fields searched for names are fetched by the anonymization scan
+ANON_PROJECTION = {"subject": True, "content": True}
+
+# More partitions than processes keep the pool busy despite uneven partitions
+ANON_PARTITIONS_PER_PROCESS = 4
+
+ANON_CHECKPOINT = "anon"
+
+# Advices are stamped before their bulk write commits, possibly while a scan runs
+ANON_CHECKPOINT_MARGIN = timedelta(minutes=5)
+
 click.disable_unicode_literals_warning = True
 
 
@@ -70,7 +102,7 @@ def get_replacements(candidates, starting_letter="X"):
     if len(candidates) == 1:
         return {candidates[0]: starting_letter * 3}
 
-    unique_names = set(candidates)
+    unique_names = OrderedDict.fromkeys(candidates)  # Stable replacements
     replacement = {}
     chosen_letter = starting_letter
     for name in unique_names:
@@ -179,6 +211,121 @@ cli.add_command(run_command, name="runserver")
 cli.add_command(routes_command)
 
 
+def batch_option(func):
+    """Common option for commands writing advices by batches"""
+    return click.option(
+        "--batch-size",
+        type=int,
+        default=1000,
+        show_default=True,
+        help="Number of rows written per MongoDB bulk request",
+    )(func)
+
+
+def bulk_options(func):
+    """Common options for commands relying on bulk indexing"""
+    func = click.option(
+        "--threads", type=int, help="Number of parallel bulk indexing threads"
+    )(func)
+    func = click.option(
+        "--chunk-size", type=int, help="Number of advices per bulk indexing request"
+    )(func)
+    return func
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists of at most `size` items"""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def store_rows(rows, batch_size, stats):
+    """Store CSV rows by batches, updating `stats` and yielding the written advices"""
+    for chunk in chunked(rows, batch_size):
+        advices, chunk_stats = csv.from_rows(chunk)
+        stats.update(chunk_stats)
+        yield from advices
+
+
+def read_lines(f, progress):
+    """Decode lines from a binary file object, reporting the bytes read"""
+    for line in f:
+        progress.update(len(line))
+        yield line.decode("utf-8")
+
+
+def iter_lines(response, progress):
+    """
+    Decode lines from a streamed HTTP response, reporting the bytes read.
+
+    Unlike `requests.Response.iter_lines`, line endings are kept
+    so multiline quoted CSV fields are preserved.
+    """
+    pending = b""
+    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+        progress.update(len(chunk))
+        lines = (pending + chunk).splitlines(keepends=True)
+        pending = lines.pop() if lines and not lines[-1].endswith(b"\n") else b""
+        for line in lines:
+            yield line.decode("utf-8")
+    if pending:
+        yield pending.decode("utf-8")
+
+
+def load_rows(rows, batch_size, chunk_size=None, threads=None, index=True):
+    """
+    Stream CSV rows through the parse, write and index stages.
+
+    Rows are consumed lazily by chunks of `batch_size`
+    so memory usage does not depend on the input size.
+    Written advices failing to be indexed are counted as `unindexed`.
+    """
+    stats = Counter()
+    stored = store_rows(rows, batch_size, stats)
+    if index:
+        _, stats["unindexed"] = index_advices(stored, chunk_size, threads)
+    else:
+        deque(stored, maxlen=0)
+    return stats
+
+
+def report(stats):
+    """Display a load summary"""
+    success(
+        "Processed {0} rows: {1} new, {2} changed, {3} unchanged, {4} failed",
+        stats["new"] + stats["changed"] + stats["unchanged"] + stats["failed"],
+        green(stats["new"]),
+        cyan(stats["changed"]),
+        stats["unchanged"],
+        red(stats["failed"]) if stats["failed"] else stats["failed"],
+    )
+    if stats["unindexed"]:
+        warning("{0} advices could not be indexed", red(stats["unindexed"]))
+
+
+def index_advices(advices, chunk_size=None, threads=None, index_name=None):
+    """
+    Bulk index advices and report failures.
+
+    Advices failing to be indexed lose their fingerprint
+    so the next load writes and indexes them again.
+    Returns the numbers of indexed and failed advices.
+    """
+    indexed, failures = bulk_index(
+        advices, chunk_size=chunk_size, thread_count=threads, index_name=index_name
+    )
+    for id, reason in failures:
+        warning("Unable to index {0}: {1}", white(id), reason)
+    if failures:
+        Advice._get_collection().update_many(
+            {"_id": {"$in": [id for id, _ in failures]}}, {"$unset": {"fingerprint": ""}}
+        )
+    return indexed, len(failures)
+
+
 @cli.command()
 @click.argument("patterns", nargs=-1)
 @click.option(
@@ -188,77 +335,197 @@ cli.add_command(routes_command)
     is_flag=True,
     help="Trigger a full reindexation instead of indexing new advices",
 )
-def load(patterns, full_reindex):
+@batch_option
+@bulk_options
+@click.pass_context
+def load(ctx, patterns, full_reindex, batch_size, chunk_size, threads):
     """
     Load one or more CADA CSV files matching patterns
     """
     header("Loading CSV files")
+    changed = False
     for pattern in patterns:
         for filename in iglob(pattern):
             echo("Loading {}".format(white(filename)))
-            with open(filename) as f:
-                reader = csv.reader(f)
+            size = os.path.getsize(filename)
+            with open(filename, "rb") as f, tqdm(total=size, unit="B", unit_scale=True) as progress:
+                reader = csv.reader(read_lines(f, progress))
 
                 # Skip header
-                reader.__next__()
+                next(reader, None)
 
-                advices = list(reader)
+                stats = load_rows(reader, batch_size, chunk_size, threads, index=not full_reindex)
+                report(stats)
+                changed = changed or stats["new"] or stats["changed"]
+    if changed:
+        ctx.invoke(export)
+    if full_reindex:
+        # Reindexing swaps to a new generation, invalidating the cache
+        ctx.invoke(reindex, chunk_size=chunk_size, threads=threads)
+    elif changed:
+        cache.invalidate()
 
-                for row in tqdm(advices):
-                    try:
-                        advice = csv.from_row(row)
-                        if not full_reindex:
-                            index(advice)
-                    except Exception as e:
-                        log.warning(e)
 
-                success("Processed {0} rows", len(advices))
-    if full_reindex:
-        reindex()
+def load_source(url, batch_size, chunk_size=None, threads=None, force=False, position=0):
+    """
+    Stream a remote CSV file into the load pipeline.
+
+    The source HTTP validators (`ETag` and `Last-Modified`) are stored
+    so an unchanged remote file is skipped on the next run unless `force` is set.
+    They are cleared if some rows failed to be loaded or indexed,
+    so the file is downloaded and its failed rows retried on the next run.
+
+    Returns the load stats or `None` if the remote file did not change.
+    """
+    source = Source.objects(url=url).first() or Source(url=url)
+    headers = {}
+    if not force and source.etag:
+        headers["If-None-Match"] = source.etag
+    if not force and source.last_modified:
+        headers["If-Modified-Since"] = source.last_modified
+
+    with requests.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            return
+        response.raise_for_status()
+        size = int(response.headers.get("Content-Length", 0)) or None
+        with tqdm(total=size, unit="B", unit_scale=True, desc=url, position=position) as progress:
+            reader = csv.reader(iter_lines(response, progress))
+
+            # Skip header
+            next(reader, None)
+
+            stats = load_rows(reader, batch_size, chunk_size, threads)
+
+        if stats["failed"] or stats["unindexed"]:
+            source.etag = source.last_modified = None
+        else:
+            source.etag = response.headers.get("ETag")
+            source.last_modified = response.headers.get("Last-Modified")
+    source.loaded = datetime.utcnow()
+    source.save()
+    return stats
 
 
 @cli.command()
-@click.argument("url")
-def load_url(url):
+@click.argument("urls", nargs=-1, required=True)
+@click.option(
+    "-j", "--jobs", type=int, default=4, show_default=True, help="Number of concurrent downloads"
+)
+@click.option(
+    "-f", "--force", is_flag=True, help="Load the remote files even if they did not change"
+)
+@batch_option
+@bulk_options
+@click.pass_context
+def load_url(ctx, urls, jobs, force, batch_size, chunk_size, threads):
     """
-    Load a remote csv file
+    Load one or more remote csv files
     """
-    header("Loading remote csv file")
-    echo(f"🌏 URL: {url}")
+    header("Loading remote csv files")
+    for url in urls:
+        echo(f"🌏 URL: {url}")
+
+    app = current_app._get_current_object()
 
-    r = requests.get(url)
-    text = r.content.decode("utf-8")
-    reader = csv.reader(text.splitlines())
+    def load(position, url):
+        with app.app_context():
+            return load_source(url, batch_size, chunk_size, threads, force, position)
 
-    # Skip header
-    reader.__next__()
-    advices = list(reader)
+    with refresh_disabled(es.index_name), ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [(url, executor.submit(load, i, url)) for i, url in enumerate(urls)]
 
-    for row in tqdm(advices):
+    changed = False
+    for url, future in futures:
         try:
-            advice = csv.from_row(row)
-            index(advice)
+            stats = future.result()
         except Exception as e:
-            log.warning(e)
-
-    success("Processed {0} rows", len(advices))
+            warning("Unable to load {0}: {1}", white(url), e)
+            continue
+        if stats is None:
+            echo("{0} {1} did not change, skipping", cyan(INFO), white(url))
+        else:
+            echo("{0} {1}", cyan(INFO), white(url))
+            report(stats)
+            changed = changed or stats["new"] or stats["changed"]
+    if changed:
+        ctx.invoke(export)
+        cache.invalidate()
 
 
 @cli.command()
-def reindex():
+@bulk_options
+def reindex(chunk_size, threads):
     """Reindex all advices"""
     header("Reindexing all advices")
-    echo("Deleting index {0}", white(es.index_name))
-    if es.indices.exists(es.index_name):
-        es.indices.delete(index=es.index_name)
-    es.initialize()
+    index_name = es.create_index()
+    echo("Building index {0}", white(index_name))
+
+    advices = Advice.objects
+    try:
+        indexed, _ = index_advices(tqdm(advices, total=advices.count()), chunk_size, threads, index_name)
+    except Exception:
+        es.indices.delete(index=index_name, ignore=[404])
+        raise
+
+    echo("Pointing {0} to {1}", white(es.index_name), white(index_name))
+    es.swap(index_name)
+    cache.invalidate()
+
+    success("Indexed {0} advices", indexed)
+
 
-    for advice in tqdm(Advice.objects):
-        index(advice)
+@cli.command()
+def export():
+    """Generate the compressed CSV export served on /export"""
+    path = current_app.config["EXPORT_PATH"]
+    echo("Writing export into {0}", white(path))
+    csv.write_export(path, current_app.config["EXPORT_CHUNK_SIZE"])
+    success("Export generated")
+
+
+def explained_queries(collection):
+    """The main queries of the application and the CLI, by description"""
+    since = datetime.utcnow() - timedelta(days=1)
+    return [
+        ("Sitemap scan", collection.find({}, {"last_modified": 1}).sort("_id", 1)),
+        ("Lookup by id", collection.find({"_id": "1"}, {"fingerprint": 1, "last_modified": 1})),
+        ("Dump by modification date", collection.find({"last_modified": {"$gte": since}}).sort("_id", 1)),
+        ("Dump by session date", collection.find({"session": {"$gte": since}}).sort("_id", 1)),
+        ("Advices by administration", collection.find({"administration": "Commune de Paris"})),
+        ("Advices by tag", collection.find({"tags": "urbanisme"})),
+    ]
+
+
+def describe_plan(stage):
+    """Flatten a query plan stages into a readable chain, with the indexes used"""
+    stage = stage.get("queryPlan", stage)
+    steps = []
+    while stage:
+        step = stage["stage"]
+        if "indexName" in stage:
+            step += " ({0})".format(stage["indexName"])
+        steps.append(step)
+        stage = stage.get("inputStage")
+    return " < ".join(steps)
 
-    es.indices.refresh(index=es.index_name)
 
-    success("Indexed {0} advices", len(Advice.objects))
+@cli.command()
+def indexes():
+    """Build the MongoDB indexes in background and explain the main queries"""
+    header(indexes.__doc__)
+    Advice.ensure_indexes()
+    collection = Advice._get_collection()
+    for name, info in sorted(collection.index_information().items()):
+        echo("{0}: {1}", white(name), ", ".join(field for field, _ in info["key"]))
+
+    for description, cursor in explained_queries(collection):
+        plan = describe_plan(cursor.explain()["queryPlanner"]["winningPlan"])
+        if "COLLSCAN" in plan:
+            warning("{0}: {1}", white(description), plan)
+        else:
+            echo("{0}: {1}", white(description), plan)
+    success("Done")
 
 
 @cli.command()
@@ -273,6 +540,11 @@ def static(path, no_input):
     cmdenv = CommandLineEnvironment(assets, log)
     cmdenv.build()
 
+    echo("Precompressing assets")
+    encodings = current_app.config["COMPRESS_ALGORITHMS"]
+    for filename in precompress_static(assets.directory, encodings):
+        log.debug("Precompressed %s", filename)
+
     if exists(path):
         warning(
             "{0} directory already exists and will be {1}", white(path), white("erased")
@@ -287,91 +559,235 @@ def static(path, no_input):
     success("Done")
 
 
-@cli.command()
-def anon():
-    """Check for candidates to anonymization"""
-    header(anon.__doc__)
-    filename = "urls_to_check.csv"
-
-    # This regex is to match names after the prefixes.
-    match_regex = r"(%s)\s+([A-Z][^X\s\.\-\,]\w+)(\s+)?([A-Z]\.)?" % PREFIXES
-
-    with open(filename, "w") as csvfile:
-        writer = csv.writer(csvfile)
-        # Generate header
-        writer.writerow(csv.ANON_HEADER)
-        idx = 0
-        n_replacements = 0
-        for idx, advice in enumerate(Advice.objects, 1):
-            replace = []
-            for possible_location in [advice["subject"], advice["content"]]:
-                matches = re.findall(match_regex, possible_location)
-                if not matches:
-                    continue
-                good_matches = []
-                for m in matches:
-                    if (
-                        len(m) == 4
-                    ):  # We have a pseudonymized last name (p.ex. Isabelle L.)
-                        good_matches.append("{0}{1}{2}".format(m[1], m[2], m[3]))
-                    else:
-                        good_matches.append(m[1])
-
-                if not good_matches:
-                    continue
-                replace += good_matches
+def find_candidates(advice):
+    """Find the names candidates to anonymization in a raw advice subject and content"""
+    replace = []
+    for possible_location in (advice.get("subject"), advice.get("content")):
+        if not possible_location:
+            continue
+        for m in MATCHER.findall(possible_location):
+            # Keep pseudonymized last names (p.ex. Isabelle L.)
+            replace.append("{0}{1}{2}".format(m[1], m[2], m[3]))
+    return replace
+
+
+def anon_partitions(count, query=None):
+    """Split the advices matching `query` into at most `count` contiguous `_id` ranges of similar sizes"""
+    buckets = list(
+        Advice._get_collection().aggregate(
+            [
+                {"$match": query or {}},
+                {"$bucketAuto": {"groupBy": "$_id", "buckets": count}},
+            ],
+            allowDiskUse=True,
+        )
+    )
+    # Bucket upper bounds are exclusive, except for the last one
+    return [
+        (bucket["_id"]["min"], bucket["_id"]["max"], idx == len(buckets) - 1)
+        for idx, bucket in enumerate(buckets)
+    ]
+
+
+def anon_worker_settings():
+    """The current application settings a scanning process needs to reach the same database"""
+    return {
+        key: value
+        for key, value in current_app.config.items()
+        if key.startswith("MONGODB_") or key == "TESTING"
+    }
+
+
+def init_anon_worker(settings):
+    """Create the application with the parent `settings` in a spawned scanning process"""
+    create_app(type("AnonWorkerConfig", (object,), settings)).app_context().push()
+
+
+def scan_partition(partition):
+    """
+    Scan an `_id` range for anonymization candidates
+    and write them as `(id, replace, with)` rows into a partial CSV file.
+
+    Returns the partial file path, the number of scanned advices and of candidates.
+    """
+    query, start, end, last, path = partition
+    query = dict(query, _id={"$gte": start, ("$lte" if last else "$lt"): end})
+    cursor = Advice._get_collection().find(query, projection=ANON_PROJECTION).sort("_id", 1)
+    scanned = found = 0
+    with open(path, "w", newline="") as partial:
+        writer = csv.writer(partial)
+        for scanned, advice in enumerate(cursor, 1):
+            replace = find_candidates(advice)
             if not replace:
                 continue
-            n_replacements += 1
+            found += 1
             replacements = get_replacements(replace)
             writer.writerow(
-                csv.to_anon_row(
-                    advice,
-                    ",".join(replace),
-                    ",".join([replacements[n] for n in replace]),
-                )
+                (advice["_id"], ",".join(replace), ",".join(replacements[n] for n in replace))
             )
-            echo("." if idx % 50 else white(idx), nl=False)
-        echo(white(idx) if idx % 50 else "")
+    return path, scanned, found
+
 
-    # success('Total: {0} candidates', idx)
+@cli.command()
+@click.option(
+    "-p", "--processes", type=int, default=os.cpu_count(), help="Number of scanning processes"
+)
+@click.option("--full", is_flag=True, help="Scan all advices, not only the ones modified since the last scan")
+def anon(processes, full):
+    """
+    Check for candidates to anonymization
+
+    Only the advices modified since the previous scan start (minus a safety margin)
+    are scanned, so advices stamped before a scan but written during it are not missed.
+    """
+    header("Check for candidates to anonymization")
+    filename = ANON_FILENAME
+    processes = max(processes or 1, 1)
+
+    checkpoint = Checkpoint.objects(name=ANON_CHECKPOINT).first() or Checkpoint(name=ANON_CHECKPOINT)
+    if full or not checkpoint.timestamp:
+        query = {}
+        echo("Scanning all advices")
+    else:
+        query = {"last_modified": {"$gte": checkpoint.timestamp}}
+        echo("Scanning advices modified since {0}", white(checkpoint.timestamp.isoformat()))
+    # Advices modified during the scan (or stamped just before it) will be scanned again by the next one
+    started = datetime.utcnow() - ANON_CHECKPOINT_MARGIN
+
+    workdir = tempfile.mkdtemp()
+    partitions = [
+        (query, start, end, last, os.path.join(workdir, "{0}.csv".format(idx)))
+        for idx, (start, end, last) in enumerate(
+            anon_partitions(processes * ANON_PARTITIONS_PER_PROCESS, query)
+        )
+    ]
+    pool = None
+    if processes > 1 and len(partitions) > 1:
+        pool = multiprocessing.get_context("spawn").Pool(
+            processes, initializer=init_anon_worker, initargs=(anon_worker_settings(),)
+        )
+    try:
+        # Results are yielded in partitions order, whatever the completion order
+        results = pool.imap(scan_partition, partitions) if pool else map(scan_partition, partitions)
+        n_replacements = 0
+        with open(filename, "w") as csvfile, tqdm(
+            total=Advice.objects(__raw__=query).count(), unit="advices"
+        ) as progress:
+            writer = csv.writer(csvfile)
+            # Generate header
+            writer.writerow(csv.ANON_HEADER)
+            for path, scanned, found in results:
+                with open(path, newline="") as partial:
+                    for advice_id, replace, with_ in csv.reader(partial):
+                        writer.writerow(csv.to_anon_row({"_id": advice_id}, replace, with_))
+                n_replacements += found
+                progress.update(scanned)
+    finally:
+        if pool:
+            pool.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    checkpoint.timestamp = started
+    checkpoint.save()
     success("Total: {0} replacements", n_replacements)
 
 
-@cli.command()
-@click.argument("csvfile", default="fix.csv", type=click.File("r"))
-def fix(csvfile):
-    """Apply a fix (ie. remove plain names)"""
-    header("Apply fixes from {}", csvfile.name)
-    bads = []
+def read_fixes(csvfile):
+    """Read `(id, sources, dests)` fixes from an anonymization CSV file"""
     reader = csv.reader(csvfile)
     reader.__next__()  # Skip header
-
     for id, _, sources, dests in reader:
-        advice = Advice.objects.get(id=id)
         sources = [s.strip() for s in sources.split(",") if s.strip()]
         dests = [d.strip() for d in dests.split(",") if d.strip()]
+        yield id, sources, dests
+
+
+def save_fixes(advices):
+    """Write the fixed fields of advices with a single unordered bulk write, returning the written ones"""
+    operations = [
+        UpdateOne(
+            {"_id": a.id},
+            {
+                "$set": {
+                    "subject": a.subject,
+                    "content": a.content,
+                    "fingerprint": a.fingerprint,
+                    "last_modified": a.last_modified,
+                }
+            },
+        )
+        for a in advices
+    ]
+    try:
+        Advice._get_collection().bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        failed = set()
+        for err in e.details["writeErrors"]:
+            advice = advices[err["index"]]
+            warning("Unable to write {0}: {1}", white(advice.id), err["errmsg"])
+            failed.add(advice.id)
+        advices = [a for a in advices if a.id not in failed]
+    return advices
+
+
+@cli.command()
+@click.argument("csvfile", default="fix.csv", type=click.File("r"))
+@click.option("-n", "--dry-run", is_flag=True, help="Report the replacements without writing them")
+@click.pass_context
+def fix(ctx, csvfile, dry_run):
+    """Apply a fix (ie. remove plain names)"""
+    header("Apply fixes from {}", csvfile.name)
+    bads = []
+    unknowns = []
+    fixes = list(read_fixes(csvfile))
+    advices = Advice.objects.in_bulk([id for id, _, _ in fixes])
+    originals = {id: (advice.subject, advice.content) for id, advice in advices.items()}
+
+    for id, sources, dests in fixes:
+        advice = advices.get(id)
+        if advice is None:
+            unknowns.append(id)
+            continue
 
         if not len(sources) == len(dests):
             bads.append(id)
             continue
 
         for source, dest in zip(sources, dests):
+            occurrences = advice.subject.count(source) + advice.content.count(source)
             echo(
-                "{0}: Replace {1} with {2}".format(
-                    white(id), white(source), white(dest)
-                )
+                "{0}: Replace {1} with {2} ({3} occurrences)",
+                white(id), white(source), white(dest), occurrences
             )
             advice.subject = advice.subject.replace(source, dest)
             advice.content = advice.content.replace(source, dest)
 
-        advice.save()
-        index(advice)
+    # An advice can be fixed by many rows but is only written once
+    now = datetime.utcnow()
+    fixed = []
+    for advice in advices.values():
+        if (advice.subject, advice.content) != originals[advice.id]:
+            advice.fingerprint = advice.compute_fingerprint()
+            advice.last_modified = now
+            fixed.append(advice)
 
     for id in bads:
         echo("{0}: Replacements length not matching", white(id))
+    for id in unknowns:
+        echo("{0}: Unknown advice", white(id))
 
-    success("Done")
+    if dry_run:
+        success("{0} advices would be fixed", len(fixed))
+        return
+
+    fixed = save_fixes(fixed) if fixed else fixed
+    index_advices(fixed)
+
+    if fixed:
+        ctx.invoke(export)
+        cache.invalidate()
+
+    success("{0} advices fixed", len(fixed))
 
 
 @cli.command()
@@ -379,4 +795,7 @@ def burnthemall():
     """Delete all advices"""
 
     Advice.objects.delete()
+    if exists(current_app.config["EXPORT_PATH"]):
+        os.remove(current_app.config["EXPORT_PATH"])
+    cache.invalidate()
     echo("{0} All advices have been deleted", green(OK))
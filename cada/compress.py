@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import zlib
+
+from flask import current_app, request, send_from_directory
+
+DEFAULT_MIMETYPES = (
+    "text/html",
+    "text/css",
+    "text/csv",
+    "text/plain",
+    "text/xml",
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "text/javascript",
+    "application/xml",
+    "image/svg+xml",
+)
+
+#: Extensions of the static files worth precompressing
+STATIC_EXTENSIONS = (".css", ".js", ".svg", ".json", ".txt", ".xml")
+
+#: File suffix of the precompressed variants by encoding
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+class GzipEncoder(object):
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, data):
+        return gzip.compress(data, self.level)
+
+    def compressor(self):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress, compressor.flush
+
+
+class BrotliEncoder(object):
+    def __init__(self, quality):
+        # Optional dependency
+        import brotli
+
+        self.brotli = brotli
+        self.quality = quality
+
+    def compress(self, data):
+        return self.brotli.compress(data, quality=self.quality)
+
+    def compressor(self):
+        compressor = self.brotli.Compressor(quality=self.quality)
+        return compressor.process, compressor.finish
+
+
+def stream_compressed(iterable, compressor):
+    """Compress a streamed response body chunk by chunk"""
+    compress, flush = compressor
+    try:
+        for chunk in iterable:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = compress(chunk)
+            if data:
+                yield data
+        yield flush()
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+
+
+def precompress(path, encodings=("gzip",), level=9):
+    """Write the precompressed variants of a file next to it"""
+    with open(path, "rb") as f:
+        data = f.read()
+    for encoding in encodings:
+        encoder = BrotliEncoder(11) if encoding == "br" else GzipEncoder(level)
+        with open(path + SUFFIXES[encoding], "wb") as out:
+            out.write(encoder.compress(data))
+
+
+def precompress_static(directory, encodings=("gzip",)):
+    """Precompress every compressible static file in a directory tree, yielding their paths"""
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith(STATIC_EXTENSIONS):
+                path = os.path.join(root, filename)
+                precompress(path, encodings)
+                yield path
+
+
+class Compress(object):
+    """
+    Compress the responses negotiated on `Accept-Encoding`.
+
+    Streamed responses are compressed on the fly, buffered ones only above `COMPRESS_MIN_SIZE`
+    and static files are served from their precompressed variant when there is one.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("COMPRESS_ALGORITHMS", ["gzip"])
+        app.config.setdefault("COMPRESS_MIMETYPES", DEFAULT_MIMETYPES)
+        app.config.setdefault("COMPRESS_LEVEL", 6)
+        app.config.setdefault("COMPRESS_BROTLI_QUALITY", 4)
+        app.config.setdefault("COMPRESS_MIN_SIZE", 500)
+        app.extensions["compress"] = self.create_encoders(app.config)
+        app.after_request(self.after_request)
+
+    def create_encoders(self, config):
+        """Instanciate the encoders in `COMPRESS_ALGORITHMS` order of preference"""
+        encoders = {}
+        for encoding in config["COMPRESS_ALGORITHMS"]:
+            if encoding == "gzip":
+                encoders[encoding] = GzipEncoder(config["COMPRESS_LEVEL"])
+            elif encoding == "br":
+                encoders[encoding] = BrotliEncoder(config["COMPRESS_BROTLI_QUALITY"])
+            else:
+                raise ValueError("Unknown compression algorithm: {0}".format(encoding))
+        return encoders
+
+    @property
+    def encoders(self):
+        if "compress" not in current_app.extensions.keys():
+            raise Exception("not initialised, did you forget to call init_app?")
+        return current_app.extensions["compress"]
+
+    def negotiate(self):
+        """The preferred encoding accepted by the client, if any"""
+        return request.accept_encodings.best_match(list(self.encoders.keys()))
+
+    def after_request(self, response):
+        config = current_app.config
+        if (
+            response.status_code != 200
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in config["COMPRESS_MIMETYPES"]
+        ):
+            return response
+        response.vary.add("Accept-Encoding")
+
+        encoding = self.negotiate()
+        if not encoding:
+            return response
+
+        if response.direct_passthrough:
+            # Files are only compressed ahead of time
+            return self.precompressed(response, encoding) or response
+
+        encoder = self.encoders[encoding]
+        if response.is_streamed:
+            response.response = stream_compressed(response.response, encoder.compressor())
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < config["COMPRESS_MIN_SIZE"]:
+                return response
+            response.set_data(encoder.compress(data))
+
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            # The compressed body is no longer byte-for-byte identical
+            response.set_etag(etag, weak=True)
+        return response
+
+    def precompressed(self, response, encoding):
+        """Serve the precompressed variant of a static file if it exists"""
+        if not request.endpoint or not request.endpoint.split(".")[-1] == "static":
+            return
+        if request.blueprint:
+            folder = current_app.blueprints[request.blueprint].static_folder
+        else:
+            folder = current_app.static_folder
+        filename = request.view_args["filename"] + SUFFIXES[encoding]
+        if not folder or not os.path.isfile(os.path.join(folder, filename)):
+            return
+        variant = send_from_directory(folder, filename, mimetype=response.mimetype, conditional=True)
+        variant.headers["Content-Encoding"] = encoding
+        variant.vary.add("Accept-Encoding")
+        return variant
+
+
+compress = Compress()
@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 import csv
+import gzip
+import io
+import logging
+import os
 
+from collections import Counter
 from flask import url_for
 from datetime import datetime
 
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
 from cada.models import Advice
 
+log = logging.getLogger(__name__)
+
 
 HEADER = [
     'Numéro de dossier',
@@ -24,6 +34,16 @@ HEADER = [
 
 ANON_HEADER = ('id', 'url', 'replace', 'with')
 
+EXPORT_FIELDS = (
+    'administration', 'type', 'session', 'subject', 'topics', 'tags', 'meanings', 'part', 'content'
+)
+
+# Number of rows per chunk yielded by the export
+EXPORT_CHUNK_SIZE = 500
+
+# Number of documents fetched per MongoDB round trip by the export
+EXPORT_CURSOR_SIZE = 1000
+
 
 def reader(f):
     '''CSV Reader factory for CADA format'''
@@ -55,10 +75,10 @@ def cleanup(text):
     return text.replace('&quot;', '"').replace('&amp;', '&')
 
 
-def from_row(row):
-    '''Create an advice from a CSV row'''
+def parse_row(row):
+    '''Parse a CSV row into an unsaved advice'''
     subject = (row[5][0].upper() + row[5][1:]) if row[5] else row[5]
-    return Advice.objects.create(
+    advice = Advice(
         id=row[0],
         administration=cleanup(row[1]),
         type=row[2],
@@ -70,25 +90,132 @@ def from_row(row):
         part=_part(row[9]),
         content=cleanup(row[10]),
     )
+    advice.validate()
+    return advice
+
+
+def from_row(row):
+    '''Create an advice from a CSV row'''
+    advice = parse_row(row)
+    advice.last_modified = datetime.utcnow()
+    return advice.save()
+
+
+def from_rows(rows):
+    '''
+    Create or update advices from CSV rows using a single unordered bulk upsert.
+
+    Rows whose fingerprint did not change are not written.
+    Returns the list of written advices
+    and a counter of `new`, `changed`, `unchanged` and `failed` rows.
+    '''
+    stats = Counter(new=0, changed=0, unchanged=0, failed=0)
+    advices = []
+    for row in rows:
+        try:
+            advices.append(parse_row(row))
+        except Exception as e:
+            log.warning('Unable to parse row %s: %s', row[0] if row else '?', e)
+            stats['failed'] += 1
+
+    collection = Advice._get_collection()
+    ids = [a.id for a in advices]
+    fingerprints = {
+        doc['_id']: doc.get('fingerprint')
+        for doc in collection.find({'_id': {'$in': ids}}, {'fingerprint': 1})
+    }
+    unchanged = [a for a in advices if fingerprints.get(a.id) == a.fingerprint]
+    stats['unchanged'] += len(unchanged)
+    advices = [a for a in advices if fingerprints.get(a.id) != a.fingerprint]
+    if not advices:
+        return advices, stats
+
+    now = datetime.utcnow()
+    for advice in advices:
+        advice.last_modified = now
+    requests = [ReplaceOne({'_id': a.id}, a.to_mongo(), upsert=True) for a in advices]
+    try:
+        result = collection.bulk_write(requests, ordered=False).bulk_api_result
+    except BulkWriteError as e:
+        result = e.details
+        failed = set()
+        for err in result['writeErrors']:
+            advice = advices[err['index']]
+            log.warning('Unable to write advice %s: %s', advice.id, err['errmsg'])
+            failed.add(advice.id)
+        stats['failed'] += len(failed)
+        advices = [a for a in advices if a.id not in failed]
+
+    stats['new'] += result['nUpserted'] + result['nInserted']
+    stats['changed'] += result['nMatched']
+    return advices, stats
 
 
 def to_row(advice):
-    '''Serialize an advice into a CSV row'''
+    '''Serialize an advice (a document or a raw MongoDB dict) into a CSV row'''
+    if isinstance(advice, Advice):
+        advice = advice.to_mongo()
+    session = advice['session']
     return [
-        advice.id,
-        advice.administration,
-        advice.type,
-        advice.session.year,
-        advice.session.strftime('%d/%m/%Y'),
-        advice.subject,
-        ', '.join(advice.topics),
-        ', '.join(advice.tags),
-        ', '.join(advice.meanings),
-        ROMAN_NUMS.get(advice.part, ''),
-        advice.content,
+        advice['_id'],
+        advice.get('administration'),
+        advice.get('type'),
+        session.year,
+        session.strftime('%d/%m/%Y'),
+        advice.get('subject'),
+        ', '.join(advice.get('topics', [])),
+        ', '.join(advice.get('tags', [])),
+        ', '.join(advice.get('meanings', [])),
+        ROMAN_NUMS.get(advice.get('part'), ''),
+        advice.get('content'),
     ]
 
 
+def export(chunk_size=EXPORT_CHUNK_SIZE):
+    '''
+    Generate the full CSV export, yielding it by chunks of `chunk_size` rows.
+
+    Advices are read as raw dicts from a single MongoDB cursor
+    and written through a single reused buffer.
+    '''
+    csvfile = io.StringIO()
+    writer_ = writer(csvfile)
+    # Generate header
+    writer_.writerow(HEADER)
+
+    cursor = Advice._get_collection().find(
+        {}, EXPORT_FIELDS, sort=[('_id', 1)], batch_size=EXPORT_CURSOR_SIZE
+    )
+    rows = []
+    for advice in cursor:
+        rows.append(to_row(advice))
+        if len(rows) >= chunk_size:
+            writer_.writerows(rows)
+            rows = []
+            yield csvfile.getvalue()
+            csvfile.seek(0)
+            csvfile.truncate()
+    writer_.writerows(rows)
+    yield csvfile.getvalue()
+
+
+def write_export(path, chunk_size=EXPORT_CHUNK_SIZE):
+    '''
+    Write the gzip-compressed CSV export to `path`.
+
+    The file is written aside then atomically moved into place
+    so a partially written export is never served.
+    '''
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmp = '{0}.tmp'.format(path)
+    with gzip.open(tmp, 'wt', encoding='utf-8', newline='') as out:
+        for chunk in export(chunk_size):
+            out.write(chunk)
+    os.replace(tmp, path)
+
+
 def to_anon_row(advice, replace='', with_=''):
     if isinstance(advice, Advice):
         return advice.id, url_for('site.display', id=advice.id, _external=True), replace, with_
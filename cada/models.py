@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
+
 from flask_mongoengine import MongoEngine
 
 db = MongoEngine()
@@ -23,6 +26,61 @@ class Advice(db.Document):
     meanings = db.ListField(db.StringField())
     part = db.IntField()
     content = db.StringField()
+    fingerprint = db.StringField()
+    last_modified = db.DateTimeField()
+
+    meta = {
+        'indexes': [
+            'session',
+            'administration',
+            'tags',
+            'last_modified',
+            # Covers the sitemap id-ordered scans
+            ('id', 'last_modified'),
+        ],
+        # Indexes are built explicitly by `cada indexes`, not on startup
+        'auto_create_index': False,
+        'index_background': True,
+    }
 
     def __unicode__(self):
         return self.subject
+
+    def clean(self):
+        self.fingerprint = self.compute_fingerprint()
+
+    def compute_fingerprint(self):
+        '''A hash of the normalized advice fields, used to detect changes'''
+        fields = [
+            self.id,
+            self.administration,
+            self.type,
+            self.session.strftime('%Y-%m-%d') if self.session else None,
+            self.subject,
+            self.topics,
+            self.tags,
+            self.meanings,
+            self.part,
+            self.content,
+        ]
+        data = json.dumps(fields, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class Source(db.Document):
+    url = db.StringField(primary_key=True)
+    etag = db.StringField()
+    last_modified = db.StringField()
+    loaded = db.DateTimeField()
+
+    def __unicode__(self):
+        return self.url
+
+
+class Checkpoint(db.Document):
+    """Where an incremental processing stopped"""
+    name = db.StringField(primary_key=True)
+    timestamp = db.DateTimeField()
+
+    def __unicode__(self):
+        return self.name
@@ -1,18 +1,32 @@
 # -*- coding: utf-8 -*-
+import base64
+import hashlib
+import json
 import logging
+import re
+import threading
 
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
 
-from elasticsearch import Elasticsearch
-from flask import current_app, request
+from elasticsearch import Elasticsearch, RequestError
+from elasticsearch.helpers import parallel_bulk, streaming_bulk
+from flask import abort, current_app, request
+from werkzeug.datastructures import MultiDict
 
+from cada.cache import cache
 from cada.models import Advice
 
 log = logging.getLogger(__name__)
 
 MAPPING = {
     "properties": {
-        "id": {"type": "text", "index": "true"},
+        "id": {
+            "type": "text",
+            "index": "true",
+            "fields": {"keyword": {"type": "keyword"}},
+        },
         "administration": {
             "type": "text",
             "analyzer": "fr_analyzer",
@@ -82,11 +96,14 @@ FIELDS = (
 )
 
 SORTS = {
-    "topic": "topics.raw",
-    "administration": "administration.raw",
+    "topic": "topics.keyword",
+    "administration": "administration.keyword",
     "session": "session",
 }
 
+# Unique sort criterion making the results order stable for cursors
+TIEBREAKER = {"id.keyword": {"order": "asc", "unmapped_type": "keyword"}}
+
 FACETS = {
     "administration": "administration.keyword",
     "tag": "tags.keyword",
@@ -117,10 +134,27 @@ ANALYSIS = {
 }
 
 
+# Fields required to display a search result list (ie. without the content)
+LIST_FIELDS = (
+    "id",
+    "administration",
+    "type",
+    "session",
+    "subject",
+    "topics",
+    "tags",
+    "meanings",
+    "part",
+)
+
 DOCTYPE = "advice"
 DEFAULT_PAGE_SIZE = 20
 
 
+def timestamp():
+    return datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+
+
 class ElasticSearch(object):
     def __init__(self, app=None):
         if app is not None:
@@ -128,52 +162,191 @@ class ElasticSearch(object):
 
     def init_app(self, app):
         app.config.setdefault("ELASTICSEARCH_URL", "localhost:9200")
+        app.config.setdefault("ELASTICSEARCH_HOSTS", [app.config["ELASTICSEARCH_URL"]])
+        app.config.setdefault("ELASTICSEARCH_MAXSIZE", 10)
+        app.config.setdefault("ELASTICSEARCH_TIMEOUT", 10)
+        app.config.setdefault("ELASTICSEARCH_MAX_RETRIES", 3)
+        app.config.setdefault("ELASTICSEARCH_RETRY_ON_TIMEOUT", False)
+        app.config.setdefault("ELASTICSEARCH_HTTP_COMPRESS", False)
+        app.config.setdefault("ELASTICSEARCH_REFRESH_INTERVAL", None)
+        app.config.setdefault("ELASTICSEARCH_BULK_CHUNK_SIZE", 500)
+        app.config.setdefault("ELASTICSEARCH_BULK_THREADS", 4)
+        app.config.setdefault("ELASTICSEARCH_BULK_MAX_RETRIES", 3)
+        app.config.setdefault("ELASTICSEARCH_BULK_INITIAL_BACKOFF", 2)
+        app.config.setdefault("SEARCH_CACHE_TIMEOUT", 300)
+        app.config.setdefault("SEARCH_TRACK_TOTAL_HITS", 10000)
         app.extensions["elasticsearch"] = Elasticsearch(
-            [app.config["ELASTICSEARCH_URL"]]
+            app.config["ELASTICSEARCH_HOSTS"],
+            maxsize=app.config["ELASTICSEARCH_MAXSIZE"],
+            timeout=app.config["ELASTICSEARCH_TIMEOUT"],
+            max_retries=app.config["ELASTICSEARCH_MAX_RETRIES"],
+            retry_on_timeout=app.config["ELASTICSEARCH_RETRY_ON_TIMEOUT"],
+            http_compress=app.config["ELASTICSEARCH_HTTP_COMPRESS"],
         )
 
     def __getattr__(self, item):
-        if "elasticsearch" not in current_app.extensions.keys():
+        try:
+            client = current_app.extensions["elasticsearch"]
+        except KeyError:
             raise Exception("not initialised, did you forget to call init_app?")
-        return getattr(current_app.extensions["elasticsearch"], item)
+        return getattr(client, item)
+
+    @property
+    def client(self):
+        """The bound Elasticsearch client, usable outside of the app context"""
+        return current_app.extensions["elasticsearch"]
+
+    def pool_stats(self):
+        """
+        Usage of the HTTP connection pools of this process, by Elasticsearch host.
+
+        A `created` count growing beyond `maxsize` means the pool is undersized:
+        extra connections are opened and discarded after each request.
+        """
+        pool = self.client.transport.connection_pool
+        dead = getattr(pool, "dead_count", {})
+        stats = {}
+        for connection in getattr(pool, "orig_connections", pool.connections):
+            queue = connection.pool.pool
+            stats[connection.host] = {
+                "maxsize": queue.maxsize,
+                "in_use": queue.maxsize - queue.qsize(),
+                "idle": sum(1 for conn in list(queue.queue) if conn is not None),
+                "created": connection.pool.num_connections,
+                "requests": connection.pool.num_requests,
+                "dead": dead.get(connection, 0),
+            }
+        return stats
 
     @property
     def index_name(self):
+        """The alias pointing to the current index generation"""
         if current_app.config.get("TESTING"):
             return "{0}-test".format(current_app.name)
         return current_app.name
 
+    def generations(self):
+        """List the existing index generations names, oldest first"""
+        pattern = re.compile(r"^{0}-\d+$".format(re.escape(self.index_name)))
+        indices = self.indices.get(index="{0}-*".format(self.index_name), ignore=[404])
+        return sorted(name for name in indices if pattern.match(name))
+
+    @property
+    def generation(self):
+        """
+        An opaque token identifying the current index generation.
+
+        It changes on each reindex and each time the generation is bumped.
+        """
+        mappings = self.indices.get_mapping(index=self.index_name)
+        for name, mapping in mappings.items():
+            meta = mapping.get("mappings", {}).get("_meta", {})
+            return "{0}:{1}".format(name, meta.get("generation", ""))
+
+    def bump_generation(self):
+        """Mark the current index generation as updated, if there is one"""
+        if not self.indices.exists(index=self.index_name):
+            return
+        self.indices.put_mapping(
+            index=self.index_name, body={"_meta": {"generation": timestamp()}}
+        )
+
+    def create_index(self, aliased=False):
+        """Create a new timestamped index generation and return its name"""
+        name = "{0}-{1}".format(self.index_name, timestamp())
+        mappings = dict(MAPPING, _meta={"generation": timestamp()})
+        body = {"mappings": mappings, "settings": {"analysis": ANALYSIS}}
+        if aliased:
+            body["aliases"] = {self.index_name: {}}
+        self.indices.create(index=name, body=body)
+        return name
+
     def initialize(self):
         """Create or update indices and mappings"""
-        if es.indices.exists(self.index_name):
-            es.indices.put_mapping(
+        if self.indices.exists(self.index_name):
+            self.indices.put_mapping(
                 index=self.index_name, doc_type=DOCTYPE, body=MAPPING
             )
         else:
-            es.indices.create(
-                index=self.index_name,
-                body={
-                    "mappings": MAPPING,
-                    "settings": {"analysis": ANALYSIS},
-                },
-            )
+            self.create_index(aliased=True)
+
+    def swap(self, index_name):
+        """
+        Atomically point the alias to the `index_name` generation
+        and delete the older ones.
+        """
+        alias = self.index_name
+        actions = []
+        if self.indices.exists_alias(name=alias):
+            actions.append({"remove": {"index": "*", "alias": alias}})
+        elif self.indices.exists(alias):
+            # Legacy unversioned index, replaced by the alias
+            actions.append({"remove_index": {"index": alias}})
+        actions.append({"add": {"index": index_name, "alias": alias}})
+        self.indices.update_aliases(body={"actions": actions})
+        for name in self.generations():
+            if name != index_name:
+                self.indices.delete(index=name, ignore=[404])
 
 
 es = ElasticSearch()
 
 
-def build_text_queries():
-    if not request.args.get("q"):
-        return ""
-    query_string = request.args.get("q")
-    if isinstance(query_string, (list, tuple)):
-        query_string = " ".join(query_string)
-
-    print(query_string)
+def parse_facets(values, default=()):
+    """
+    Resolve the facets names requested by the `facets` argument values.
+
+    Values can be `all`, `none` or facets names (repeated or comma-separated).
+    `default` is used if no value is given.
+    """
+    if not values:
+        return sorted(default)
+    names = set()
+    for value in values:
+        for name in value.split(","):
+            name = name.strip()
+            if name == "all":
+                names.update(FACETS)
+            elif name in FACETS:
+                names.add(name)
+    return sorted(names)
+
+
+def normalize_args(args, facets=()):
+    """
+    Canonicalize the search arguments.
+
+    Unknown arguments are dropped, facets values are deduplicated and sorted,
+    sorts get an explicit direction and pagination defaults are filled in.
+    Requested aggregations default to `facets` if not specified.
+    """
+    normalized = MultiDict()
+    query_string = " ".join(q.strip() for q in args.getlist("q") if q.strip())
+    if query_string:
+        normalized["q"] = query_string
+    for sort in args.getlist("sort"):
+        parts = sort.split()
+        if parts and parts[0] in SORTS:
+            direction = parts[1] if len(parts) > 1 and parts[1] in ("asc", "desc") else "asc"
+            normalized.add("sort", "{0} {1}".format(parts[0], direction))
+    for name in sorted(FACETS):
+        for value in sorted(set(args.getlist(name))):
+            normalized.add(name, value)
+    normalized["page"] = str(max(int(args.get("page", 1)), 1))
+    normalized["page_size"] = str(int(args.get("page_size", DEFAULT_PAGE_SIZE)))
+    normalized.setlist("facets", parse_facets(args.getlist("facets"), facets))
+    if args.get("cursor"):
+        normalized["cursor"] = args["cursor"]
+    return normalized
+
+
+def build_text_queries(args):
+    if not args.get("q"):
+        return []
     return [
         {
             "query_string": {
-                "query": query_string,
+                "query": args["q"],
                 "default_operator": "AND",
                 "fields": FIELDS,
             }
@@ -181,64 +354,121 @@ def build_text_queries():
     ]
 
 
-def build_facet_queries():
+def build_facet_queries(args):
     queries = []
     for name, field in FACETS.items():
-        if name in request.args:
-            for term in request.args.getlist(name):
-                queries.append({"term": {field: term}})
+        for term in args.getlist(name):
+            queries.append({"term": {field: term}})
     return queries
 
 
-def build_query():
+def build_query(args):
     must = []
-    must.extend(build_text_queries())
-    must.extend(build_facet_queries())
+    must.extend(build_text_queries(args))
+    must.extend(build_facet_queries(args))
     return {"bool": {"must": must}} if must else {"match_all": {}}
 
 
-def build_aggs():
+def build_aggs(args):
     return dict(
         [
-            (name, {"terms": {"field": field, "size": 10}})
-            for name, field in FACETS.items()
+            (name, {"terms": {"field": FACETS[name], "size": 10}})
+            for name in args.getlist("facets")
         ]
     )
 
 
-def build_sort():
-    """Build sort query paramter from kwargs"""
-    sorts = request.args.getlist("sort")
-    sorts = [sorts] if isinstance(sorts, str) else sorts
-    sorts = [s.split(" ") for s in sorts]
-    return [{SORTS[s]: d} for s, d in sorts if s in SORTS]
+def build_sort(args):
+    """
+    Build sort query parameter from normalized arguments.
 
+    Sorts end with a unique tiebreaker so they can be used with `search_after`.
+    """
+    sorts = [s.split(" ") for s in args.getlist("sort")]
+    sorts = [{SORTS[s]: d} for s, d in sorts] or [{"_score": "desc"}]
+    return sorts + [TIEBREAKER]
 
-def search_advices():
-    page = max(int(request.args.get("page", 1)), 1)
-    page_size = int(request.args.get("page_size", DEFAULT_PAGE_SIZE))
-    start = (page - 1) * page_size
 
-    result = es.search(
-        index=es.index_name,
-        body={
-            "track_total_hits": True,
-            "query": build_query(),
-            "aggs": build_aggs(),
+def encode_cursor(hit):
+    """Build an opaque cursor pointing after the given hit"""
+    data = json.dumps(hit["sort"], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor, sort):
+    """Extract the `search_after` values from a cursor, one for each of the `sort` criteria"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != len(sort):
+        abort(400, "Invalid cursor")
+    return values
+
+
+def search_advices(fields=None, hydrate=False, args=None, facets=()):
+    """
+    Perform a search from the request arguments (or the given `args`).
+
+    Advices are built from the Elasticsearch hits,
+    restricted to `fields` if given (all indexed fields otherwise).
+    Full documents are fetched from MongoDB only if `hydrate` is `True`.
+    Only the `facets` aggregations are computed unless the arguments
+    specify them.
+
+    Results can be paginated either with `page` or with the opaque `cursor`
+    returned as `next`, which is not limited in depth.
+    The total is counted exactly up to `SEARCH_TRACK_TOTAL_HITS`.
+
+    Elasticsearch responses are cached for the current index generation,
+    keyed on the normalized arguments.
+    """
+    args = normalize_args(request.args if args is None else args, facets)
+    page = int(args["page"])
+    page_size = int(args["page_size"])
+    start = (page - 1) * page_size
+    if hydrate:
+        source = False
+    else:
+        source = list(fields) if fields else True
+
+    def search():
+        body = {
+            "track_total_hits": current_app.config["SEARCH_TRACK_TOTAL_HITS"],
+            "query": build_query(args),
             "from": start,
             "size": page_size,
-            "sort": build_sort(),
-        },
-    )
-
-    ids = [hit["_id"] for hit in result.get("hits", {}).get("hits", [])]
-    advices = Advice.objects.in_bulk(ids)
-    advices = [advices[id] for id in ids]
+            "sort": build_sort(args),
+            "_source": source,
+        }
+        aggs = build_aggs(args)
+        if aggs:
+            body["aggs"] = aggs
+        if "cursor" not in args:
+            return es.search(index=es.index_name, body=body)
+        body["from"] = 0
+        body["search_after"] = decode_cursor(args["cursor"], body["sort"])
+        try:
+            return es.search(index=es.index_name, body=body)
+        except RequestError:
+            # Values not matching the sorted fields types
+            abort(400, "Invalid cursor")
+
+    key = json.dumps([list(args.items(multi=True)), source], separators=(",", ":"))
+    key = "search:{0}".format(hashlib.sha1(key.encode("utf-8")).hexdigest())
+    result = cache.get_or_set(key, search, timeout=current_app.config["SEARCH_CACHE_TIMEOUT"])
+
+    hits = result.get("hits", {}).get("hits", [])
+    if hydrate:
+        ids = [hit["_id"] for hit in hits]
+        advices = Advice.objects.in_bulk(ids)
+        advices = [advices[id] for id in ids if id in advices]
+    else:
+        advices = [from_hit(hit) for hit in hits]
 
     facets = {}
     for name, content in result.get("aggregations", {}).items():
-        actives = request.args.get(name)
-        actives = [actives] if isinstance(actives, str) else actives or []
+        actives = args.getlist(name)
         facets[name] = [
             (term["key"], term["doc_count"], term["key"] in actives)
             for term in content.get("buckets", [])
@@ -250,9 +480,40 @@ def search_advices():
         "page": page,
         "page_size": page_size,
         "total": result["hits"]["total"]["value"],
+        "total_relation": result["hits"]["total"]["relation"],
+        "next": encode_cursor(hits[-1]) if hits and len(hits) == page_size else None,
     }
 
 
+def search_facets(args=None):
+    """Compute the facets of a search (all by default) without fetching any hit"""
+    args = MultiDict(request.args if args is None else args)
+    args["page_size"] = "0"
+    result = search_advices(args=args, facets=FACETS)
+    return {"facets": result["facets"], "total": result["total"]}
+
+
+def strip_parent_topics(topics):
+    """Remove the parent topics added by `to_document` for aggregations"""
+    stripped = []
+    topics = iter(topics)
+    for topic in topics:
+        stripped.append(topic)
+        if "/" in topic:
+            next(topics, None)
+    return stripped
+
+
+def from_hit(hit):
+    """Build an unsaved advice from an Elasticsearch hit source"""
+    source = dict(hit.get("_source", {}))
+    if source.get("session"):
+        source["session"] = datetime.strptime(source["session"], "%Y-%m-%d")
+    if "topics" in source:
+        source["topics"] = strip_parent_topics(source["topics"])
+    return Advice(**source)
+
+
 def agg_to_list(result, facet):
     return [
         (t["key"], t["doc_count"])
@@ -301,8 +562,8 @@ def home_data():
     }
 
 
-def index(advice):
-    """Index/Reindex a CADA advice"""
+def to_document(advice):
+    """Serialize a CADA advice into its Elasticsearch document"""
     topics = []
     for topic in advice.topics:
         topics.append(topic)
@@ -310,22 +571,127 @@ def index(advice):
         if len(parts) > 1:
             topics.append(parts[0])
 
+    return {
+        "id": advice.id,
+        "administration": advice.administration,
+        "type": advice.type,
+        "session": advice.session.strftime("%Y-%m-%d"),
+        "subject": advice.subject,
+        "topics": topics,
+        "tags": advice.tags,
+        "meanings": advice.meanings,
+        "part": advice.part,
+        "content": advice.content,
+    }
+
+
+def index(advice):
+    """Index/Reindex a CADA advice"""
     try:
-        es.index(
-            index=es.index_name,
-            id=advice.id,
-            body={
-                "id": advice.id,
-                "administration": advice.administration,
-                "type": advice.type,
-                "session": advice.session.strftime("%Y-%m-%d"),
-                "subject": advice.subject,
-                "topics": topics,
-                "tags": advice.tags,
-                "meanings": advice.meanings,
-                "part": advice.part,
-                "content": advice.content,
-            },
-        )
+        es.index(index=es.index_name, id=advice.id, body=to_document(advice))
     except Exception:
         log.exception("Unable to index advice %s", advice.id)
+
+
+# Depth of the `refresh_disabled` blocks in progress in this process, by index name
+_refresh_depths = Counter()
+_refresh_lock = threading.Lock()
+
+
+@contextmanager
+def refresh_disabled(index_name):
+    """
+    Disable the periodic refresh of an index for the duration of the block.
+
+    Nested calls (tracked in-process) are no-op: the outermost block restores
+    the `ELASTICSEARCH_REFRESH_INTERVAL` and triggers a single refresh,
+    even if a previous run died with the refresh disabled.
+    The index is created if it does not exist yet.
+    """
+    with _refresh_lock:
+        _refresh_depths[index_name] += 1
+        outermost = _refresh_depths[index_name] == 1
+        if outermost:
+            if not es.indices.exists(index_name):
+                es.initialize()
+            es.indices.put_settings(
+                index=index_name, body={"index": {"refresh_interval": "-1"}}
+            )
+    try:
+        yield
+    finally:
+        with _refresh_lock:
+            _refresh_depths[index_name] -= 1
+            if outermost:
+                del _refresh_depths[index_name]
+                interval = current_app.config["ELASTICSEARCH_REFRESH_INTERVAL"]
+                es.indices.put_settings(
+                    index=index_name, body={"index": {"refresh_interval": interval}}
+                )
+                es.indices.refresh(index=index_name)
+
+
+def bulk_index(advices, chunk_size=None, thread_count=None, index_name=None):
+    """
+    Index/Reindex many CADA advices using the bulk API.
+
+    `advices` can be any iterable (including a lazy generator or a queryset).
+    When `thread_count` is greater than 1, the iterable is consumed
+    from a worker thread, so it must not rely on the application context.
+
+    Returns a tuple `(indexed, failures)`
+    where `failures` is a list of `(id, error)` tuples.
+    Advices are indexed into the current generation unless `index_name` is given.
+
+    Items rejected by a busy cluster (`429`) are retried with an exponential backoff.
+    """
+    config = current_app.config
+    chunk_size = chunk_size or config["ELASTICSEARCH_BULK_CHUNK_SIZE"]
+    thread_count = thread_count or config["ELASTICSEARCH_BULK_THREADS"]
+    index_name = index_name or es.index_name
+
+    indexed = 0
+    failures = []
+    # Actions sent by the threaded helper and not acknowledged yet, kept to be retried
+    pending = {}
+    rejected = []
+
+    def actions():
+        for advice in advices:
+            try:
+                document = to_document(advice)
+            except Exception as e:
+                log.warning("Unable to serialize advice %s: %s", advice.id, e)
+                failures.append((advice.id, str(e)))
+                continue
+            action = {"_index": index_name, "_id": advice.id, "_source": document}
+            if thread_count > 1:
+                pending[advice.id] = action
+            yield action
+
+    def collect(results):
+        nonlocal indexed
+        for ok, item in results:
+            details = item.get("index", item)
+            action = pending.pop(details.get("_id"), None)
+            if ok:
+                indexed += 1
+            elif details.get("status") == 429 and action:
+                rejected.append(action)
+            else:
+                log.warning("Unable to index advice %s: %s", details.get("_id"), details.get("error"))
+                failures.append((details.get("_id"), details.get("error")))
+
+    kwargs = {"chunk_size": chunk_size, "raise_on_error": False}
+    retries = {
+        "max_retries": config["ELASTICSEARCH_BULK_MAX_RETRIES"],
+        "initial_backoff": config["ELASTICSEARCH_BULK_INITIAL_BACKOFF"],
+    }
+    with refresh_disabled(index_name):
+        if thread_count > 1:
+            collect(parallel_bulk(es.client, actions(), thread_count=thread_count, **kwargs))
+            # The threaded helper does not retry, rejected items are sent again sequentially
+            collect(streaming_bulk(es.client, rejected, **kwargs, **retries))
+        else:
+            collect(streaming_bulk(es.client, actions(), **kwargs, **retries))
+    return indexed, failures
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
+import gzip
 import io
+import os
 import re
 
 from datetime import datetime
 
 from urllib.parse import urlsplit, urlunsplit
 
-from flask import Blueprint, abort, render_template, url_for, request, flash, Response, redirect, current_app
+from flask import (
+    Blueprint, abort, render_template, url_for, request, flash, Response, redirect, current_app, send_file
+)
 from flask_mail import Attachment, Mail
 from flask_wtf import FlaskForm
 from jinja2 import Markup
@@ -15,11 +19,20 @@ from wtforms import TextField, ValidationError
 from wtforms.validators import InputRequired
 
 from cada import csv
+from cada.cache import cache
 from cada.models import Advice, PARTS
-from cada.search import search_advices, home_data
+from cada.search import search_advices, home_data, LIST_FIELDS, FACETS
 
 DEFAULT_PAGE_SIZE = 20
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Maximum number of URLs per sitemap allowed by the sitemaps protocol
+SITEMAP_PAGE_SIZE = 50000
+
+# Number of static URLs (home and API documentation) listed first on the first sitemap page
+SITEMAP_STATIC_URLS = 2
+
 RE_URL = re.compile(r'https?://')
 
 
@@ -139,12 +152,12 @@ def es_date(value):
 
 @site.route('/')
 def home():
-    return render_template('index.html', **home_data())
+    return render_template('index.html', **cache.get_or_set('home', home_data))
 
 
 @site.route('/search')
 def search():
-    return render_template('search.html', **search_advices())
+    return render_template('search.html', **search_advices(LIST_FIELDS, facets=FACETS))
 
 
 @site.route('/about')
@@ -199,32 +212,88 @@ def robots():
     return Response(render_template('robots.txt'), mimetype='text/plain')
 
 
+def sitemap_pages():
+    '''Compute the last modification date of each sitemap page with an id-only scan'''
+    size = current_app.config['SITEMAP_PAGE_SIZE']
+    cursor = Advice._get_collection().find({}, {'last_modified': 1}, sort=[('_id', 1)])
+    pages = [None]  # The first page always lists the static URLs
+    for idx, advice in enumerate(cursor):
+        page = (idx + SITEMAP_STATIC_URLS) // size
+        while page >= len(pages):
+            pages.append(None)
+        last_modified = advice.get('last_modified')
+        if last_modified and (pages[page] is None or last_modified > pages[page]):
+            pages[page] = last_modified
+    return pages
+
+
+def sitemap_page_range(page):
+    '''The `(skip, limit)` advices range of a sitemap page, after the static URLs'''
+    size = current_app.config['SITEMAP_PAGE_SIZE']
+    start = max((page - 1) * size - SITEMAP_STATIC_URLS, 0)
+    return start, page * size - SITEMAP_STATIC_URLS - start
+
+
+def cached_sitemap_pages():
+    return cache.get_or_set('sitemap:pages', sitemap_pages)
+
+
 @site.route('/sitemap.xml')
 def sitemap():
-    xml = render_template('sitemap.xml', advices=Advice.objects)
+    def render():
+        return render_template('sitemap.xml', pages=cached_sitemap_pages())
+    xml = cache.get_or_set('sitemap', render)
+    return Response(xml, mimetype='application/xml')
+
+
+@site.route('/sitemap-<int:page>.xml')
+def sitemap_page(page):
+    if page < 1 or page > len(cached_sitemap_pages()):
+        abort(404)
+    skip, limit = sitemap_page_range(page)
+
+    def render():
+        advices = []
+        if limit > 0:  # A zero limit means no limit for MongoDB
+            advices = Advice._get_collection().find(
+                {}, {'last_modified': 1}, sort=[('_id', 1)], skip=skip, limit=limit
+            )
+        return render_template('sitemap_page.xml', advices=advices, page=page)
+    xml = cache.get_or_set('sitemap-{0}'.format(page), render)
     return Response(xml, mimetype='application/xml')
 
 
 @site.route('/export')
 def export_csv():
-    def generate():
-        csvfile = io.StringIO()
-        writer = csv.writer(csvfile)
-        # Generate header
-        writer.writerow(csv.HEADER)
-        yield csvfile.getvalue()
+    path = os.path.abspath(current_app.config['EXPORT_PATH'])
+    if not os.path.exists(path):
+        return export_csv_live()
+
+    date = datetime.fromtimestamp(os.path.getmtime(path)).date().isoformat()
+    filename = 'cada-{0}.csv'.format(date)
+    if request.accept_encodings['gzip']:
+        response = send_file(path, mimetype='text/csv', as_attachment=True,
+                             attachment_filename=filename, conditional=True, cache_timeout=0)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        def generate():
+            with gzip.open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+                    yield chunk
+
+        headers = {'Content-Disposition': 'attachment; filename={0}'.format(filename)}
+        response = Response(generate(), mimetype='text/csv', headers=headers)
+    response.vary.add('Accept-Encoding')
+    return response
 
-        for advice in Advice.objects.order_by('id'):
-            csvfile = io.StringIO()
-            writer = csv.writer(csvfile)
-            writer.writerow(csv.to_row(advice))
-            yield csvfile.getvalue()
 
+def export_csv_live():
     date = datetime.now().date().isoformat()
     headers = {
         'Content-Disposition': 'attachment; filename=cada-{0}.csv'.format(date)
     }
-    response = Response(generate(), mimetype="text/csv", headers=headers)
+    chunks = csv.export(current_app.config['EXPORT_CHUNK_SIZE'])
+    response = Response(chunks, mimetype="text/csv", headers=headers)
     return response
 
 
@@ -234,5 +303,8 @@ def page_not_found(e):
 
 
 def init_app(app):
+    app.config.setdefault('EXPORT_PATH', os.path.join(app.instance_path, 'cada.csv.gz'))
+    app.config.setdefault('EXPORT_CHUNK_SIZE', csv.EXPORT_CHUNK_SIZE)
+    app.config.setdefault('SITEMAP_PAGE_SIZE', SITEMAP_PAGE_SIZE)
     mail.init_app(app)
     app.register_blueprint(site)
@@ -64,6 +64,8 @@ setup(
     python_requires=">=3.6",
     extras_require={
         "sentry": pip("sentry.pip"),
+        "redis": pip("redis.pip"),
+        "brotli": pip("brotli.pip"),
         "test": pip("test.pip"),
         "report": pip("report.pip"),
     },
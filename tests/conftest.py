@@ -37,6 +37,14 @@ def app():
         db.connection.drop_database(db_name)
 
 
+@pytest.fixture
+def export_path(app, tmpdir):
+    '''Write the CSV export into a temporary directory'''
+    path = str(tmpdir.join('cada.csv.gz'))
+    app.config['EXPORT_PATH'] = path
+    return path
+
+
 @pytest.fixture()
 def clean_es(app):
     with app.test_request_context('/'):
@@ -44,4 +52,4 @@ def clean_es(app):
         es.cluster.health(index=es.index_name, wait_for_status='yellow', request_timeout=1)
     yield
     with app.test_request_context('/'):
-        es.indices.delete(index=es.index_name, ignore=[400, 404])
+        es.indices.delete(index='{0}-*'.format(es.index_name), ignore=[400, 404])
@@ -1,18 +1,30 @@
+import json
 import pytest
 
+from datetime import datetime
+
 from flask import url_for
 
 from cada import search
+from cada.cache import cache
 from cada.models import PARTS
 
-@pytest.mark.usefixtures('live_server')
+
 def test_api_doc_empty(client):
     assert client.get(url_for('api.doc')).status_code == 200
 
-@pytest.mark.usefixtures('live_server')
+
 def test_api_doc_wih_advices(client, advice_factory):
-    advice_factory.create_batch(3)
+    search.bulk_index(advice_factory.create_batch(3))
+    assert client.get(url_for('api.doc')).status_code == 200
+
+
+def test_api_doc_sample_is_cached(client, advice_factory):
     assert client.get(url_for('api.doc')).status_code == 200
+    misses = cache.misses['api']
+    assert client.get(url_for('api.doc')).status_code == 200
+    assert cache.misses['api'] == misses
+    assert cache.hits['api'] >= 1
 
 
 def test_search_empty(client):
@@ -34,3 +46,162 @@ def test_display_advice(client, advice):
     assert response.status_code == 200
     assert response.json['id'] == advice.id
     assert response.json['subject'] == advice.subject
+
+
+def test_display_advice_is_conditional(app, client, advice_factory):
+    advice = advice_factory(last_modified=datetime(2019, 1, 1, 12, 0, 0))
+    url = url_for('api.display', id=advice.id)
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['ETag'] == '"{0}"'.format(advice.fingerprint)
+    assert response.headers['Last-Modified'] == 'Tue, 01 Jan 2019 12:00:00 GMT'
+    assert response.headers['Cache-Control'] == 'public, max-age={0}'.format(app.config['API_CACHE_MAX_AGE'])
+
+    response = client.get(url, headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == '"{0}"'.format(advice.fingerprint)
+
+    response = client.get(url, headers={'If-Modified-Since': 'Tue, 01 Jan 2019 12:00:00 GMT'})
+    assert response.status_code == 304
+
+    response = client.get(url, headers={'If-Modified-Since': 'Mon, 31 Dec 2018 12:00:00 GMT'})
+    assert response.status_code == 200
+
+
+def test_search_with_bulk_indexed_content(client, advice_factory):
+    indexed, failures = search.bulk_index(advice_factory.create_batch(3))
+    assert indexed == 3
+    assert failures == []
+    response = client.get(url_for('api.search'))
+    assert response.status_code == 200
+    assert len(response.json['advices']) == 3
+
+
+def test_search_facets_are_opt_in(client, advice_factory):
+    search.bulk_index(advice_factory.create_batch(3))
+
+    response = client.get(url_for('api.search'))
+    assert response.json['facets'] == {}
+
+    response = client.get(url_for('api.search', facets='tag,part'))
+    assert set(response.json['facets']) == {'tag', 'part'}
+
+    response = client.get(url_for('api.search', facets='all'))
+    assert set(response.json['facets']) == set(search.FACETS)
+
+
+def test_facets(client, advice_factory):
+    search.bulk_index(advice_factory.create_batch(3))
+    response = client.get(url_for('api.facets'))
+    assert response.status_code == 200
+    assert response.json['total'] == 3
+    assert set(response.json['facets']) == set(search.FACETS)
+    assert 'advices' not in response.json
+
+
+def test_search_with_cursor(client, advice_factory):
+    search.bulk_index([advice_factory.create(id='advice-{0}'.format(i)) for i in range(5)])
+
+    ids = []
+    response = client.get(url_for('api.search', page_size=2, sort='session desc'))
+    while True:
+        assert response.status_code == 200
+        ids.extend(advice['id'] for advice in response.json['advices'])
+        if not response.json['next']:
+            break
+        response = client.get(url_for('api.search', page_size=2, sort='session desc',
+                                      cursor=response.json['next']))
+
+    assert sorted(ids) == ['advice-{0}'.format(i) for i in range(5)]
+
+
+def test_search_with_invalid_cursor(client):
+    assert client.get(url_for('api.search', cursor='invalid')).status_code == 400
+
+
+def test_search_with_mismatching_cursor(client, advice_factory):
+    search.bulk_index(advice_factory.create_batch(3))
+
+    def cursor(values):
+        return search.encode_cursor({'sort': values})
+
+    assert client.get(url_for('api.search', cursor=cursor(['x']))).status_code == 400
+    response = client.get(url_for('api.search', sort='session desc', cursor=cursor(['x', 'y'])))
+    assert response.status_code == 400
+
+
+def test_search_total_is_bounded(app, client, advice_factory):
+    app.config['SEARCH_TRACK_TOTAL_HITS'] = 2
+    search.bulk_index(advice_factory.create_batch(3))
+    response = client.get(url_for('api.search'))
+    assert response.json['total'] == 2
+    assert response.json['total_relation'] == 'gte'
+
+
+def test_batch_display(client, advice_factory):
+    for i in range(3):
+        advice_factory.create(id='advice-{0}'.format(i))
+
+    response = client.get(url_for('api.batch', ids='advice-2,advice-0,unknown'))
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert [a['id'] for a in response.json['advices']] == ['advice-2', 'advice-0']
+    assert response.json['missing'] == ['unknown']
+
+
+def test_batch_display_with_fields(client, advice_factory):
+    advices = advice_factory.create_batch(2)
+
+    response = client.post(url_for('api.batch'), json={
+        'ids': [a.id for a in advices],
+        'fields': ['id', 'subject'],
+    })
+    assert response.status_code == 200
+    for advice, data in zip(advices, response.json['advices']):
+        assert data == {'id': advice.id, 'subject': advice.subject}
+
+
+def test_batch_display_is_bounded(app, client):
+    app.config['API_MAX_BATCH_SIZE'] = 2
+    assert client.get(url_for('api.batch', ids='a,b,c')).status_code == 400
+
+
+def test_dump(client, advice_factory):
+    ids = ['advice-{0}'.format(i) for i in range(3)]
+    for id in ids:
+        advice_factory.create(id=id)
+
+    response = client.get(url_for('api.dump'))
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.is_streamed
+    advices = [json.loads(line) for line in response.data.decode('utf8').splitlines()]
+    assert [a['id'] for a in advices] == ids
+    assert advices[0] == client.get(url_for('api.display', id=ids[0])).json
+
+
+def test_dump_since(client, advice_factory):
+    advice_factory.create(id='old', session=datetime(2018, 1, 1), last_modified=datetime(2018, 1, 1))
+    advice_factory.create(id='new', session=datetime(2020, 1, 1), last_modified=datetime(2020, 1, 1))
+
+    for by in ('session', 'modified'):
+        response = client.get(url_for('api.dump', since='2019-01-01', by=by))
+        assert [json.loads(line)['id'] for line in response.data.decode('utf8').splitlines()] == ['new']
+
+    assert client.get(url_for('api.dump', since='not-a-date')).status_code == 400
+    assert client.get(url_for('api.dump', since='2019-01-01', by='unknown')).status_code == 400
+
+
+def test_stats_are_disabled_by_default(client):
+    assert client.get(url_for('api.stats')).status_code == 404
+
+
+def test_stats(app, client):
+    app.config['API_STATS'] = True
+    client.get(url_for('api.search'))
+    response = client.get(url_for('api.stats'))
+    assert response.status_code == 200
+    [pool] = response.json['elasticsearch'].values()
+    assert pool['maxsize'] == app.config['ELASTICSEARCH_MAXSIZE']
+    assert pool['requests'] >= 1
+    assert response.json['cache']['search']['misses'] >= 1
@@ -0,0 +1,407 @@
+import io
+
+from datetime import datetime
+
+from cada import commands, csv, search
+from cada.commands import ANON_CHECKPOINT_MARGIN, cli, find_candidates, get_replacements, iter_lines
+from cada.models import Advice, Checkpoint, Source
+
+
+def test_find_candidates():
+    advice = {
+        'subject': 'Madame Dupont c/ Commune de Paris',
+        'content': 'Monsieur Martin L. a saisi la commission',
+    }
+    assert find_candidates(advice) == ['Dupont ', 'Martin L.']
+
+
+def test_find_candidates_with_abbreviated_prefixes():
+    advice = {'subject': 'M. Dupont et Mme Durand', 'content': 'Me Petit pour le demandeur'}
+    assert find_candidates(advice) == ['Dupont ', 'Durand', 'Petit ']
+
+
+def test_find_candidates_without_names():
+    assert find_candidates({'subject': 'Commune de Paris', 'content': None}) == []
+
+
+def test_get_replacements_are_stable():
+    assert get_replacements(['Dupont', 'Martin', 'Dupont']) == {'Dupont': 'XXX', 'Martin': 'YYY'}
+
+
+class Progress(object):
+    def __init__(self):
+        self.n = 0
+
+    def update(self, n):
+        self.n += n
+
+
+class FakeResponse(object):
+    """A streamed `requests` response serving `body` by chunks of `chunk_size` bytes"""
+    def __init__(self, body=b'', status_code=200, headers=None, chunk_size=7):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.chunk_size = chunk_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        assert self.status_code < 400
+
+    def iter_content(self, chunk_size=None):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start:start + self.chunk_size]
+
+
+def mock_get(monkeypatch, *responses):
+    """Replace `requests.get` by successive fake responses, returning the calls headers"""
+    calls = []
+    responses = list(responses)
+
+    def get(url, headers=None, **kwargs):
+        calls.append(headers or {})
+        return responses.pop(0)
+
+    monkeypatch.setattr('cada.commands.requests.get', get)
+    return calls
+
+
+def to_csv(*advices):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(csv.HEADER)
+    writer.writerows(csv.to_row(advice) for advice in advices)
+    return out.getvalue().encode('utf-8')
+
+
+def write_csv(tmpdir, *advices):
+    path = tmpdir.join('cada.csv')
+    path.write_binary(to_csv(*advices))
+    return str(path)
+
+
+def test_load(app, advice_factory, tmpdir, export_path):
+    advices = [advice_factory.build(id=str(i), session=datetime(2019, 1, 1)) for i in range(3)]
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(cli, ['load', '--batch-size', '2', write_csv(tmpdir, *advices)])
+    assert result.exit_code == 0
+    assert '3 new, 0 changed, 0 unchanged, 0 failed' in result.output
+
+    advices[1].content = 'Première ligne\nDeuxième ligne'
+    multiline = advice_factory.build(id='3', session=datetime(2019, 1, 1), content='Ligne 1\r\nLigne 2')
+    invalid = advice_factory.build(id='4', session=datetime(2001, 2, 3))
+    path = tmpdir.join('cada.csv')
+    path.write_binary(to_csv(advices[0], advices[1], multiline, invalid).replace(b'03/02/2001', b'invalid'))
+
+    result = runner.invoke(cli, ['load', '--batch-size', '2', str(path)])
+    assert result.exit_code == 0
+    assert 'Processed 4 rows: 1 new, 1 changed, 1 unchanged, 1 failed' in result.output
+
+    assert Advice.objects.count() == 4
+    assert Advice.objects.get(id='1').content == 'Première ligne\nDeuxième ligne'
+    assert Advice.objects.get(id='3').content == 'Ligne 1\r\nLigne 2'
+    search.es.indices.refresh(index=search.es.index_name)
+    assert search.es.count(index=search.es.index_name)['count'] == 4
+    hit = search.es.get(index=search.es.index_name, id='1')
+    assert hit['_source']['content'] == 'Première ligne\nDeuxième ligne'
+
+
+def test_load_retries_unindexed_rows(app, advice_factory, tmpdir, export_path, monkeypatch):
+    path = write_csv(tmpdir, *[advice_factory.build(id=str(i)) for i in range(3)])
+    to_document = search.to_document
+
+    def failing_to_document(advice):
+        if advice.id == '1':
+            raise ValueError('Unserializable')
+        return to_document(advice)
+
+    monkeypatch.setattr('cada.search.to_document', failing_to_document)
+    result = app.test_cli_runner().invoke(cli, ['load', path])
+    assert result.exit_code == 0
+    assert Advice.objects.get(id='1').fingerprint is None
+
+    monkeypatch.setattr('cada.search.to_document', to_document)
+    result = app.test_cli_runner().invoke(cli, ['load', path])
+    assert result.exit_code == 0
+    assert '0 new, 1 changed, 2 unchanged, 0 failed' in result.output
+    search.es.indices.refresh(index=search.es.index_name)
+    assert search.es.exists(index=search.es.index_name, id='1')
+
+
+def current_generation():
+    generations = search.es.generations()
+    assert len(generations) == 1
+    assert search.es.indices.exists_alias(name=search.es.index_name, index=generations[0])
+    return generations[0]
+
+
+def test_reindex(app, advice_factory, monkeypatch):
+    es = search.es
+    search.bulk_index(advice_factory.create_batch(3))
+    es.indices.refresh(index=es.index_name)
+    index_advices = commands.index_advices
+
+    def checked_index_advices(*args, **kwargs):
+        # The previous generation keeps serving during the rebuild
+        assert es.count(index=es.index_name)['count'] == 3
+        return index_advices(*args, **kwargs)
+
+    monkeypatch.setattr('cada.commands.index_advices', checked_index_advices)
+    runner = app.test_cli_runner()
+    for _ in range(2):
+        previous = current_generation()
+
+        result = runner.invoke(cli, ['reindex'])
+
+        assert result.exit_code == 0, result.output
+        assert current_generation() != previous
+        es.indices.refresh(index=es.index_name)
+        assert es.count(index=es.index_name)['count'] == 3
+
+
+def test_reindex_failure_keeps_the_current_generation(app, advice_factory, monkeypatch):
+    advice_factory.create_batch(3)
+    previous = current_generation()
+
+    def failing_index_advices(*args, **kwargs):
+        raise RuntimeError('Elasticsearch is down')
+
+    monkeypatch.setattr('cada.commands.index_advices', failing_index_advices)
+    result = app.test_cli_runner().invoke(cli, ['reindex'])
+
+    assert result.exit_code != 0
+    assert current_generation() == previous
+
+
+def test_reindex_replaces_a_legacy_index(app, advice_factory):
+    es = search.es
+    advice_factory.create_batch(3)
+    es.indices.delete(index='{0}-*'.format(es.index_name))
+    es.indices.create(index=es.index_name)
+    es.index(index=es.index_name, id='legacy', body={'subject': 'Legacy'}, refresh=True)
+
+    result = app.test_cli_runner().invoke(cli, ['reindex'])
+
+    assert result.exit_code == 0, result.output
+    current_generation()
+    es.indices.refresh(index=es.index_name)
+    assert es.count(index=es.index_name)['count'] == 3
+    assert not es.exists(index=es.index_name, id='legacy')
+
+
+def test_iter_lines_keeps_multiline_fields_across_chunks(advice_factory):
+    advice = advice_factory.build(id='1', content='Première ligne\nDeuxième ligne\r\nTroisième ligne')
+    body = to_csv(advice)
+    progress = Progress()
+
+    rows = list(csv.reader(iter_lines(FakeResponse(body, chunk_size=5), progress)))
+
+    assert progress.n == len(body)
+    assert len(rows) == 2
+    assert rows[1][0] == '1'
+    assert rows[1][10] == 'Première ligne\nDeuxième ligne\r\nTroisième ligne'
+
+
+def test_load_url_with_multiline_fields(app, advice_factory, export_path, monkeypatch):
+    advices = [advice_factory.build(id=str(i), content='Ligne {0}\nSuite'.format(i)) for i in range(3)]
+    mock_get(monkeypatch, FakeResponse(to_csv(*advices), headers={'ETag': '"v1"'}))
+
+    result = app.test_cli_runner().invoke(cli, ['load_url', 'http://example.com/cada.csv'])
+
+    assert result.exit_code == 0
+    assert Advice.objects.count() == 3
+    assert Advice.objects.get(id='1').content == 'Ligne 1\nSuite'
+
+
+def test_load_url_skips_unchanged_sources(app, advice_factory, export_path, monkeypatch):
+    url = 'http://example.com/cada.csv'
+    Source(url=url, etag='"v1"', last_modified='Tue, 01 Jan 2019 12:00:00 GMT').save()
+    calls = mock_get(monkeypatch, FakeResponse(status_code=304))
+
+    result = app.test_cli_runner().invoke(cli, ['load_url', url])
+
+    assert result.exit_code == 0
+    assert 'did not change' in result.output
+    assert calls == [{'If-None-Match': '"v1"', 'If-Modified-Since': 'Tue, 01 Jan 2019 12:00:00 GMT'}]
+    assert Advice.objects.count() == 0
+
+
+def test_load_url_force_ignores_validators(app, advice_factory, export_path, monkeypatch):
+    url = 'http://example.com/cada.csv'
+    Source(url=url, etag='"v1"').save()
+    body = to_csv(advice_factory.build(id='1'))
+    calls = mock_get(monkeypatch, FakeResponse(body, headers={'ETag': '"v2"'}))
+
+    result = app.test_cli_runner().invoke(cli, ['load_url', '--force', url])
+
+    assert result.exit_code == 0
+    assert calls == [{}]
+    assert Advice.objects.count() == 1
+    assert Source.objects.get(url=url).etag == '"v2"'
+
+
+def test_load_url_retries_sources_with_failures(app, advice_factory, export_path, monkeypatch):
+    url = 'http://example.com/cada.csv'
+    Source(url=url, etag='"v1"').save()
+    valid = advice_factory.build(id='1', session=datetime(2019, 1, 1))
+    invalid = advice_factory.build(id='2', session=datetime(2001, 2, 3))
+    body = to_csv(valid, invalid).replace(b'03/02/2001', b'not a date')
+    mock_get(monkeypatch, FakeResponse(body, headers={'ETag': '"v2"'}))
+
+    result = app.test_cli_runner().invoke(cli, ['load_url', url])
+
+    assert result.exit_code == 0
+    assert '1 failed' in result.output
+    assert Advice.objects.count() == 1
+    source = Source.objects.get(url=url)
+    assert source.etag is None
+    assert source.last_modified is None
+
+
+def read_anon_rows(tmpdir):
+    with tmpdir.join('urls_to_check.csv').open() as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == list(csv.ANON_HEADER)
+    return [(row[0], row[2], row[3]) for row in rows[1:]]
+
+
+def test_anon(app, advice_factory, tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    advice_factory(id='1', subject='Madame Dupont c/ Commune de Paris', content='Rien')
+    advice_factory(id='2', subject='Commune de Paris', content='Rien')
+    advice_factory(id='3', subject='Commune de Lyon', content='Monsieur Martin a saisi la commission')
+
+    result = app.test_cli_runner().invoke(cli, ['anon', '--processes', '1'])
+
+    assert result.exit_code == 0
+    assert read_anon_rows(tmpdir) == [('1', 'Dupont ', 'XXX'), ('3', 'Martin ', 'XXX')]
+
+
+def test_anon_in_processes(app, advice_factory, tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    for i in range(9):
+        advice_factory(id=str(i), subject='Commune de Paris', content='Monsieur Martin a saisi la commission')
+    advice_factory(id='9', subject='Madame Dupont c/ Commune de Paris', content='Rien')
+
+    result = app.test_cli_runner().invoke(cli, ['anon', '--processes', '2'])
+
+    assert result.exit_code == 0, result.output
+    expected = [(str(i), 'Martin ', 'XXX') for i in range(9)] + [('9', 'Dupont ', 'XXX')]
+    assert read_anon_rows(tmpdir) == expected
+
+
+def test_anon_is_incremental(app, advice_factory, tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    advice_factory(id='1', subject='Madame Dupont c/ Commune de Paris', content='Rien')
+    advice = advice_factory(id='2', subject='Commune de Paris', content='Rien')
+    runner = app.test_cli_runner()
+
+    assert runner.invoke(cli, ['anon', '--processes', '1']).exit_code == 0
+    assert read_anon_rows(tmpdir) == [('1', 'Dupont ', 'XXX')]
+    assert Checkpoint.objects.get(name='anon').timestamp is not None
+
+    started = datetime.utcnow()
+    assert runner.invoke(cli, ['anon', '--processes', '1']).exit_code == 0
+    assert read_anon_rows(tmpdir) == []
+
+    # Stamped before the previous scan started but written after it
+    advice.content = 'Monsieur Martin a saisi la commission'
+    advice.last_modified = started - ANON_CHECKPOINT_MARGIN / 2
+    advice.save()
+    assert runner.invoke(cli, ['anon', '--processes', '1']).exit_code == 0
+    assert read_anon_rows(tmpdir) == [('2', 'Martin ', 'XXX')]
+
+    assert runner.invoke(cli, ['anon', '--processes', '1', '--full']).exit_code == 0
+    assert read_anon_rows(tmpdir) == [('1', 'Dupont ', 'XXX'), ('2', 'Martin ', 'XXX')]
+
+
+def write_fixes(tmpdir, *rows):
+    path = tmpdir.join('fix.csv')
+    with path.open('w') as f:
+        writer = csv.writer(f)
+        writer.writerow(csv.ANON_HEADER)
+        writer.writerows(rows)
+    return str(path)
+
+
+def test_fix(app, advice_factory, tmpdir, export_path):
+    advice = advice_factory(id='1', subject='Madame Dupont c/ Commune de Paris', content='Madame Dupont')
+    untouched = advice_factory(id='2', subject='Commune de Paris', content='Rien')
+    path = write_fixes(
+        tmpdir, ('1', 'url', 'Dupont', 'XXX'), ('2', 'url', 'Durand', 'XXX'), ('3', 'url', 'Martin', 'XXX')
+    )
+
+    result = app.test_cli_runner().invoke(cli, ['fix', path])
+
+    assert result.exit_code == 0
+    assert '3: Unknown advice' in result.output
+    advice.reload()
+    assert advice.subject == 'Madame XXX c/ Commune de Paris'
+    assert advice.content == 'Madame XXX'
+    assert advice.fingerprint == advice.compute_fingerprint()
+    assert advice.last_modified is not None
+    untouched.reload()
+    assert untouched.last_modified is None
+    search.es.indices.refresh(index=search.es.index_name)
+    hit = search.es.get(index=search.es.index_name, id='1')
+    assert hit['_source']['subject'] == 'Madame XXX c/ Commune de Paris'
+
+
+def test_fix_only_writes_changed_advices(app, advice_factory, tmpdir, export_path):
+    legacy = advice_factory(id='1', subject='Commune de Paris', content='Rien')
+    # Advices stored before fingerprints
+    Advice._get_collection().update_one({'_id': '1'}, {'$unset': {'fingerprint': 1}})
+    mismatching = advice_factory(id='2', subject='Madame Dupont c/ Commune de Paris', content='Rien')
+    path = write_fixes(tmpdir, ('1', 'url', 'Dupont', 'XXX'), ('2', 'url', 'Dupont,Durand', 'XXX'))
+
+    result = app.test_cli_runner().invoke(cli, ['fix', path])
+
+    assert result.exit_code == 0
+    assert '2: Replacements length not matching' in result.output
+    assert '0 advices fixed' in result.output
+    legacy.reload()
+    assert legacy.fingerprint is None
+    assert legacy.last_modified is None
+    mismatching.reload()
+    assert mismatching.subject == 'Madame Dupont c/ Commune de Paris'
+    assert mismatching.last_modified is None
+
+
+def test_fix_dry_run(app, advice_factory, tmpdir):
+    advice = advice_factory(id='1', subject='Madame Dupont c/ Commune de Paris', content='Madame Dupont')
+    path = write_fixes(tmpdir, ('1', 'url', 'Dupont', 'XXX'))
+
+    result = app.test_cli_runner().invoke(cli, ['fix', path, '--dry-run'])
+
+    assert result.exit_code == 0
+    assert '2 occurrences' in result.output
+    assert '1 advices would be fixed' in result.output
+    advice.reload()
+    assert advice.subject == 'Madame Dupont c/ Commune de Paris'
+
+
+def test_burnthemall_without_index(app, advice_factory, export_path):
+    advice_factory.create_batch(3)
+    search.es.indices.delete(index='{0}-*'.format(search.es.index_name))
+
+    result = app.test_cli_runner().invoke(cli, ['burnthemall'])
+
+    assert result.exit_code == 0
+    assert Advice.objects.count() == 0
+
+
+def test_indexes(app, advice_factory):
+    advice_factory.create_batch(3)
+
+    result = app.test_cli_runner().invoke(cli, ['indexes'])
+
+    assert result.exit_code == 0
+    assert 'last_modified_1' in Advice._get_collection().index_information()
+    assert 'Sitemap scan: PROJECTION_COVERED < IXSCAN (_id_1_last_modified_1)' in result.output
+    assert 'IXSCAN (last_modified_1)' in result.output
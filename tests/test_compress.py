@@ -0,0 +1,66 @@
+import gzip
+
+from flask import Response, jsonify
+
+from cada.compress import precompress_static
+
+
+def test_compress_large_response(app, client):
+    @app.route('/large')
+    def large():
+        response = jsonify(data='x' * 1000)
+        response.set_etag('version')
+        return response
+
+    response = client.get('/large', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'] == 'W/"version"'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data).startswith(b'{')
+
+
+def test_do_not_compress_small_response(app, client):
+    @app.route('/small')
+    def small():
+        return jsonify(data='x')
+
+    response = client.get('/small', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+
+def test_do_not_compress_unaccepted(app, client):
+    @app.route('/large')
+    def large():
+        return jsonify(data='x' * 1000)
+
+    response = client.get('/large')
+    assert 'Content-Encoding' not in response.headers
+    assert response.json['data'] == 'x' * 1000
+
+
+def test_compress_streamed_response(app, client):
+    @app.route('/stream')
+    def stream():
+        return Response(('line {0}\n'.format(i) for i in range(100)), mimetype='text/csv')
+
+    response = client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in response.headers
+    lines = gzip.decompress(response.data).decode('utf8').splitlines()
+    assert lines == ['line {0}'.format(i) for i in range(100)]
+
+
+def test_serve_precompressed_static(app, client, tmpdir):
+    tmpdir.join('cada.css').write('body {}\n' * 100)
+    assert list(precompress_static(str(tmpdir))) == [str(tmpdir.join('cada.css'))]
+    app.static_folder = str(tmpdir)
+
+    response = client.get('/static/cada.css', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.mimetype == 'text/css'
+    assert gzip.decompress(response.data) == b'body {}\n' * 100
+
+    response = client.get('/static/cada.css')
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == b'body {}\n' * 100
@@ -1,10 +1,11 @@
+import gzip
 import io
 import pytest
 
 from flask import url_for
 
 from cada import csv
-from cada.models import PARTS
+from cada.models import Advice, PARTS
 
 
 def test_export_csv_empty(client):
@@ -29,9 +30,68 @@ def test_export_csv_with_content(client, advice, advice_factory):
     assert len([row for row in reader]) == 1 + total_advices  # Include headers
 
 
+def test_export_csv_artifact(client, advice_factory, export_path):
+    advice_factory.create_batch(3)
+    csv.write_export(export_path)
+
+    response = client.get(url_for('site.export_csv'), headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Last-Modified' in response.headers
+    reader = csv.reader(io.StringIO(gzip.decompress(response.data).decode('utf8')))
+    assert len([row for row in reader]) == 1 + 3
+
+    response = client.get(url_for('site.export_csv'), headers={
+        'Accept-Encoding': 'gzip',
+        'If-None-Match': response.headers['ETag'],
+    })
+    assert response.status_code == 304
+
+
+def test_export_csv_artifact_uncompressed(client, advice_factory, export_path):
+    advice_factory.create_batch(3)
+    csv.write_export(export_path)
+
+    response = client.get(url_for('site.export_csv'))
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    reader = csv.reader(io.StringIO(response.data.decode('utf8')))
+    assert len([row for row in reader]) == 1 + 3
+
+
+@pytest.mark.parametrize('advice__part', PARTS.keys())
+def test_to_row_from_raw_document(advice):
+    assert csv.to_row(advice.to_mongo().to_dict()) == csv.to_row(advice)
+
+
+def test_export_csv_by_chunks(app, advice_factory):
+    advice_factory.create_batch(5)
+    chunks = list(csv.export(chunk_size=2))
+    assert len(chunks) == 3
+    reader = csv.reader(io.StringIO(''.join(chunks)))
+    assert len([row for row in reader]) == 1 + 5
+
+
 @pytest.mark.parametrize('advice__part', PARTS.keys())
 def test_export_anonymisation_csv(advice):
     row = csv.to_anon_row(advice)
     assert len(row) == 4
     assert row[0] == advice.id
     assert row[1] == url_for('site.display', id=advice.id, _external=True)
+
+
+def test_from_rows_bulk_upsert(advice_factory):
+    rows = [csv.to_row(advice_factory.build(id='advice-{0}'.format(i))) for i in range(3)]
+
+    advices, stats = csv.from_rows(rows + [['invalid']])
+    assert len(advices) == 3
+    assert stats == {'new': 3, 'changed': 0, 'unchanged': 0, 'failed': 1}
+    assert all(a.fingerprint and a.last_modified for a in Advice.objects)
+
+    rows[0][5] = 'Modified subject'
+    advices, stats = csv.from_rows(rows)
+    assert [a.id for a in advices] == ['advice-0']
+    assert stats == {'new': 0, 'changed': 1, 'unchanged': 2, 'failed': 0}
+    assert Advice.objects.count() == 3
+    assert Advice.objects.get(id='advice-0').subject == 'Modified subject'
@@ -3,6 +3,7 @@ import pytest
 from flask import url_for
 
 from cada import search
+from cada.cache import cache
 from cada.models import PARTS
 from cada.views import mail
 
@@ -18,11 +19,31 @@ def test_render_home_with_content(client, advice_factory):
     assert client.get(url_for('site.home')).status_code == 200
 
 
+def test_render_home_is_cached_until_generation_changes(client, advice_factory):
+    assert b'parmi les 0 disponibles' in client.get(url_for('site.home')).data
+    search.bulk_index(advice_factory.create_batch(3))
+    assert b'parmi les 0 disponibles' in client.get(url_for('site.home')).data
+    cache.invalidate()
+    assert b'parmi les 3 disponibles' in client.get(url_for('site.home')).data
+
+
 @pytest.mark.parametrize('advice__part', PARTS.keys())
 def test_display_advice(client, advice):
     assert client.get(url_for('site.display', id=advice.id)).status_code == 200
 
 
+def test_display_advice_is_always_rendered(client, advice):
+    # The page embeds a per-session CSRF token so it must never be revalidated from a stale copy
+    url = url_for('site.display', id=advice.id)
+    response = client.get(url, headers={'If-None-Match': '"{0}"'.format(advice.fingerprint)})
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+
+
+def test_display_unknown_advice(client):
+    assert client.get(url_for('site.display', id='unknown')).status_code == 404
+
+
 def test_alert_advice(app, client, advice):
     with mail.record_messages() as mails:
         response = client.post(url_for('site.alert', id=advice.id), data={
@@ -67,5 +88,33 @@ def test_sitemap(client, advice_factory):
     assert client.get(url_for('site.sitemap')).status_code == 200
 
 
+def test_sitemap_pages(app, client, advice_factory):
+    app.config['SITEMAP_PAGE_SIZE'] = 3
+    for i in range(5):
+        advice_factory.create(id='advice-{0}'.format(i))
+
+    response = client.get(url_for('site.sitemap'))
+    assert response.status_code == 200
+    assert response.data.count(b'<sitemap>') == 3
+
+    # The home and API documentation URLs come first
+    urls = []
+    for page in range(1, 4):
+        response = client.get(url_for('site.sitemap_page', page=page))
+        assert response.status_code == 200
+        assert response.data.count(b'<url>') <= 3
+        urls.extend(response.data.decode('utf8').split('<loc>')[1:])
+    assert len(urls) == 2 + 5
+    assert all('advice-{0}'.format(i) in url for i, url in enumerate(urls[2:]))
+
+    assert client.get(url_for('site.sitemap_page', page=4)).status_code == 404
+
+
+def test_sitemap_pages_bounds_without_advices(client):
+    assert client.get(url_for('site.sitemap_page', page=1)).status_code == 200
+    assert client.get(url_for('site.sitemap_page', page=0)).status_code == 404
+    assert client.get(url_for('site.sitemap_page', page=2)).status_code == 404
+
+
 def test_robots_txt(client):
     assert client.get(url_for('site.robots')).status_code == 200
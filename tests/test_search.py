@@ -0,0 +1,116 @@
+from datetime import datetime
+
+from elasticsearch.helpers import streaming_bulk
+from werkzeug.datastructures import MultiDict
+
+from cada.cache import cache
+from cada.search import (
+    es, bulk_index, refresh_disabled, from_hit, to_document, search_advices, normalize_args, LIST_FIELDS
+)
+
+
+def test_initialize_creates_an_aliased_generation(app):
+    generations = es.generations()
+    assert len(generations) == 1
+    assert es.indices.exists_alias(name=es.index_name, index=generations[0])
+
+
+def test_swap_to_a_new_generation(app, advice_factory):
+    previous = es.generations()
+    index_name = es.create_index()
+    indexed, failures = bulk_index(advice_factory.create_batch(3), index_name=index_name)
+    assert indexed == 3
+
+    es.swap(index_name)
+
+    assert es.generations() == [index_name]
+    assert not any(es.indices.exists(name) for name in previous)
+    assert es.count(index=es.index_name)['count'] == 3
+
+
+def test_bulk_index_retries_rejected_items(app, advice_factory, monkeypatch):
+    app.config['ELASTICSEARCH_BULK_INITIAL_BACKOFF'] = 0
+
+    def rejecting_bulk(client, actions, thread_count=None, **kwargs):
+        actions = list(actions)
+        yield False, {'index': {'_id': actions[0]['_id'], 'status': 429, 'error': 'rejected'}}
+        yield from streaming_bulk(client, actions[1:], **kwargs)
+
+    monkeypatch.setattr('cada.search.parallel_bulk', rejecting_bulk)
+
+    indexed, failures = bulk_index(advice_factory.create_batch(3), thread_count=2)
+
+    assert (indexed, failures) == (3, [])
+    es.indices.refresh(index=es.index_name)
+    assert es.count(index=es.index_name)['count'] == 3
+
+
+def refresh_interval():
+    settings = es.indices.get_settings(index=es.index_name, name='index.refresh_interval')
+    return [s['settings'].get('index', {}).get('refresh_interval') for s in settings.values()]
+
+
+def test_refresh_disabled_restores_the_interval_once_nested(app):
+    with refresh_disabled(es.index_name):
+        assert refresh_interval() == ['-1']
+        with refresh_disabled(es.index_name):
+            assert refresh_interval() == ['-1']
+        assert refresh_interval() == ['-1']
+    assert refresh_interval() != ['-1']
+
+
+def test_refresh_disabled_recovers_from_an_interrupted_run(app):
+    es.indices.put_settings(index=es.index_name, body={'index': {'refresh_interval': '-1'}})
+    with refresh_disabled(es.index_name):
+        pass
+    assert refresh_interval() != ['-1']
+
+
+def test_from_hit_restores_the_advice(advice_factory):
+    advice = advice_factory.build(
+        session=datetime(2019, 7, 1), topics=['Topic/Subtopic', 'Other'], tags=['tag']
+    )
+    result = from_hit({'_source': to_document(advice)})
+    assert result.to_mongo() == advice.to_mongo()
+
+
+def test_search_advices_from_source(app, advice_factory):
+    advices = {a.id: a for a in advice_factory.create_batch(3)}
+    bulk_index(advices.values())
+
+    results = search_advices(LIST_FIELDS)['advices']
+    assert len(results) == 3
+    for result in results:
+        assert result.subject == advices[result.id].subject
+        assert result.content is None
+
+    results = search_advices(hydrate=True)['advices']
+    assert all(result.content == advices[result.id].content for result in results)
+
+
+def test_normalize_args():
+    args = MultiDict([
+        ('tag', 'b'), ('tag', 'a'), ('tag', 'a'), ('unknown', 'x'), ('q', ' paris '), ('sort', 'session'),
+    ])
+    assert list(normalize_args(args).items(multi=True)) == [
+        ('q', 'paris'),
+        ('sort', 'session asc'),
+        ('tag', 'a'),
+        ('tag', 'b'),
+        ('page', '1'),
+        ('page_size', '20'),
+    ]
+
+
+def test_search_results_are_cached_on_normalized_args(app, advice_factory):
+    bulk_index(advice_factory.create_batch(3))
+
+    first = search_advices(args=MultiDict([('q', 'paris'), ('part', '1'), ('part', '2')]))
+    second = search_advices(args=MultiDict([('part', '2'), ('part', '1'), ('q', 'paris '), ('page', '1')]))
+
+    assert second['total'] == first['total']
+    assert cache.stats()['search'] == {'hits': 1, 'misses': 1}
+
+    cache.invalidate()
+    search_advices(args=MultiDict([('q', 'paris'), ('part', '1'), ('part', '2')]))
+    assert cache.stats()['search'] == {'hits': 1, 'misses': 2}